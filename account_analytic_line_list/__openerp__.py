@@ -30,7 +30,14 @@
     "description": """Adds a wizard on financial reporting to search
         the analytic lines for a given analytic account including all
         their child accounts. Ported module acy_account_analytic_lines
-        from Acysos S.L. (Sponsored by Talleres Mutilva)""",
+        from Acysos S.L. (Sponsored by Talleres Mutilva)
+
+        The lines can also be exported to a CSV or JSON Lines attachment of
+        the analytic account. The export is streamed from the database to a
+        file moved in the filestore, so large subtrees can be exported
+        without loading the lines in memory. When the attachments are
+        stored in the database, the exported file is loaded in memory to be
+        stored.""",
     "license": "AGPL-3",
     "depends": [
         "base",
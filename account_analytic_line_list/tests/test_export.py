@@ -0,0 +1,99 @@
+# -*- encoding: utf-8 -*-
+##############################################################################
+#
+#    OpenERP, Open Source Management Solution
+#    Copyright (c) 2011 Acysos S.L. (http://acysos.com) All Rights Reserved.
+#                       Ignacio Ibeas <ignacio@acysos.com>
+#                  2013 Markus SChneider <markus.schneider@initos.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import base64
+import csv
+import json
+from StringIO import StringIO
+
+from openerp.tests import common
+
+
+class TestExport(common.TransactionCase):
+
+    def setUp(self):
+        super(TestExport, self).setUp()
+        self.wizard_obj = self.env['account.analytic.view.line']
+        account_obj = self.env['account.analytic.account']
+        self.parent = account_obj.create({'name': 'Export Parent',
+                                          'code': 'EXPORT'})
+        self.child = account_obj.create({'name': 'Export Child',
+                                         'parent_id': self.parent.id})
+        for account, amount in [(self.parent, 10.0), (self.child, 20.0)]:
+            self.env['account.analytic.line'].create({
+                'account_id': account.id,
+                'name': 'Export %s' % account.name,
+                'journal_id': self.env.ref(
+                    'account.analytic_journal_sale').id,
+                'general_account_id': self.env.ref('account.a_recv').id,
+                'date': '2015-01-01',
+                'amount': amount,
+                'unit_amount': 1.0,
+            })
+
+    def _export(self, **vals):
+        vals['analytic_id'] = self.parent.id
+        wizard = self.wizard_obj.create(vals)
+        action = wizard.export_account_analytic_lines()
+        attachment = self.env['ir.attachment'].browse(
+            int(action['url'].rsplit('=', 1)[1]))
+        self.assertEqual('account.analytic.account', attachment.res_model)
+        self.assertEqual(self.parent.id, attachment.res_id)
+        return attachment.datas_fname, base64.b64decode(attachment.datas)
+
+    def test_export_csv(self):
+        filename, data = self._export(children=True, export_format='csv')
+        self.assertEqual('analytic_lines_EXPORT.csv', filename)
+        rows = list(csv.DictReader(StringIO(data)))
+        self.assertEqual(2, len(rows))
+        self.assertEqual(set(['Export Export Parent', 'Export Export Child']),
+                         set(row['name'] for row in rows))
+        self.assertAlmostEqual(30.0,
+                               sum(float(row['amount']) for row in rows))
+
+    def test_export_jsonl(self):
+        filename, data = self._export(children=False, export_format='jsonl',
+                                      from_date='2015-01-01')
+        self.assertEqual('analytic_lines_EXPORT.jsonl', filename)
+        rows = [json.loads(line) for line in data.splitlines()]
+        self.assertEqual(1, len(rows))
+        self.assertEqual('Export Export Parent', rows[0]['name'])
+        self.assertAlmostEqual(10.0, rows[0]['amount'])
+
+    def test_children_without_templates(self):
+        template = self.env['account.analytic.account'].create({
+            'name': 'Export Template',
+            'parent_id': self.parent.id,
+            'state': 'template',
+        })
+        self.env['account.analytic.line'].create({
+            'account_id': template.id,
+            'name': 'Export Template',
+            'journal_id': self.env.ref('account.analytic_journal_sale').id,
+            'general_account_id': self.env.ref('account.a_recv').id,
+            'date': '2015-01-01',
+            'amount': 5.0,
+        })
+        filename, data = self._export(children=True, export_format='csv')
+        rows = list(csv.DictReader(StringIO(data)))
+        self.assertEqual(set(['Export Export Parent', 'Export Export Child']),
+                         set(row['name'] for row in rows))
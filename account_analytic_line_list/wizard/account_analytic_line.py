@@ -20,8 +20,20 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 ##############################################################################
+import base64
+import csv
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
 from openerp.osv import orm, fields
 
+EXPORT_COLUMNS = ['date', 'account_code', 'account', 'name', 'ref',
+                  'general_account_code', 'journal_code', 'amount',
+                  'unit_amount']
+
 
 class AccountAnalyticViewLine(orm.TransientModel):
     _name = "account.analytic.view.line"
@@ -31,23 +43,51 @@ class AccountAnalyticViewLine(orm.TransientModel):
         'analytic_id': fields.many2one('account.analytic.account',
                                        'Analytic Account', required=True),
         'children': fields.boolean('With children'),
+        'from_date': fields.date('From'),
+        'to_date': fields.date('To'),
+        'export_format': fields.selection([('csv', 'CSV'),
+                                           ('jsonl', 'JSON Lines')],
+                                          'Export Format', required=True),
+    }
+
+    _defaults = {
+        'export_format': 'csv',
     }
 
-    def _append_childs(self, cr, uid, accounts, analytic_obj):
-        for child in analytic_obj.child_complete_ids:
-            accounts.append(child.id)
-            self._append_childs(cr, uid, accounts, child)
+    def _get_lines_domain(self, cr, uid, data, context=None):
+        """Return the domain of the analytic lines of the wizard.
+
+        The children are selected with a ``child_of`` predicate resolved by
+        the server through the parent_left and parent_right of the
+        accounts, so that the domain stays compact whatever the size of the
+        subtree. The children in template state and their own children are
+        left out.
+        """
+        if data['children']:
+            account_id = data['analytic_id'][0]
+            domain = [('account_id', 'child_of', [account_id])]
+            account_obj = self.pool.get('account.analytic.account')
+            template_ids = account_obj.search(
+                cr, uid, [('id', 'child_of', [account_id]),
+                          ('id', '!=', account_id),
+                          ('state', '=', 'template')], context=context)
+            if template_ids:
+                domain.append(('account_id', 'not in', account_obj.search(
+                    cr, uid, [('id', 'child_of', template_ids)],
+                    context=context)))
+        else:
+            domain = [('account_id', '=', data['analytic_id'][0])]
+        if data.get('from_date'):
+            domain.append(('date', '>=', data['from_date']))
+        if data.get('to_date'):
+            domain.append(('date', '<=', data['to_date']))
+        return domain
 
     def open_account_analytic_lines(self, cr, uid, ids, context=None):
         data = self.read(cr, uid, ids, [], context=context)[0]
-        analytic_obj = self.pool.get('account.analytic.account')\
-                                .browse(cr, uid, [data['analytic_id'][0]])[0]
-        accounts = []
-        accounts.append(analytic_obj.id)
-        if data['children'] == 1:
-            self._append_childs(cr, uid, accounts, analytic_obj)
         res = {
-            'domain': str([('account_id', 'in', accounts)]),
+            'domain': str(self._get_lines_domain(cr, uid, data,
+                                                 context=context)),
             'name': 'Analytic account lines',
             'view_type': 'form',
             'view_mode': 'tree,form',
@@ -57,3 +97,132 @@ class AccountAnalyticViewLine(orm.TransientModel):
             'context': {'search_default_to_invoice': 1},
         }
         return res
+
+    def _get_named_cursor(self, cr, name):
+        """Return a named (server-side) psycopg2 cursor in the transaction
+        of cr. The OpenERP cursor does not provide named cursors, so the
+        cursor is opened on its underlying connection."""
+        return cr._cnx.cursor(name)
+
+    def _iter_export_rows(self, cr, uid, domain, context=None):
+        """Yield the rows of the analytic lines matching ``domain``.
+
+        The lines are read through a named (server-side) cursor, so only
+        ``itersize`` rows are held in memory at once.
+        """
+        line_obj = self.pool.get('account.analytic.line')
+        query = line_obj._where_calc(cr, uid, domain, context=context)
+        line_obj._apply_ir_rules(cr, uid, query, 'read', context=context)
+        from_clause, where_clause, params = query.get_sql()
+        export_cr = self._get_named_cursor(cr, 'analytic_line_export')
+        export_cr.itersize = 2000
+        try:
+            export_cr.execute("""
+                SELECT l.date, a.code, a.name, l.name, l.ref,
+                       g.code, j.code, l.amount, l.unit_amount
+                FROM account_analytic_line l
+                    JOIN account_analytic_account a ON (a.id = l.account_id)
+                    LEFT JOIN account_account g
+                        ON (g.id = l.general_account_id)
+                    LEFT JOIN account_analytic_journal j
+                        ON (j.id = l.journal_id)
+                WHERE l.id IN (
+                    SELECT "account_analytic_line".id FROM """ +
+                              from_clause +
+                              (where_clause and " WHERE " + where_clause) +
+                              """)
+                ORDER BY l.date, l.id""", params)
+            for row in export_cr:
+                yield row
+        finally:
+            export_cr.close()
+
+    def _write_export(self, cr, uid, rows, export_format, out,
+                      context=None):
+        if export_format == 'jsonl':
+            for row in rows:
+                out.write(json.dumps(dict(zip(EXPORT_COLUMNS, row))))
+                out.write('\n')
+            return
+        writer = csv.writer(out)
+        writer.writerow(EXPORT_COLUMNS)
+        for row in rows:
+            writer.writerow([value.encode('utf-8')
+                             if isinstance(value, unicode) else value
+                             for value in row])
+
+    def _move_to_filestore(self, cr, uid, export_file, context=None):
+        """Move the export file in the filestore, under the name the
+        attachments give to their content, and return this name. The
+        checksum is computed by chunks, so the export is never loaded in
+        memory."""
+        sha = hashlib.sha1()
+        with open(export_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                sha.update(chunk)
+        fname = sha.hexdigest()
+        fname = fname[:2] + '/' + fname
+        full_path = self.pool.get('ir.attachment')._full_path(cr, uid, fname)
+        if os.path.exists(full_path):
+            # same content already stored
+            os.unlink(export_file)
+        else:
+            dirname = os.path.dirname(full_path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            shutil.move(export_file, full_path)
+        return fname
+
+    def _store_export(self, cr, uid, wizard, export_file, filename,
+                      context=None):
+        """Create an attachment on the analytic account from the export
+        file.
+
+        When the attachments are stored in the filestore, the file is moved
+        there and the attachment is created on it. When they are stored in
+        the database, the content has to be encoded in memory.
+        """
+        attachment_obj = self.pool.get('ir.attachment')
+        vals = {
+            'name': filename,
+            'datas_fname': filename,
+            'res_model': 'account.analytic.account',
+            'res_id': wizard.analytic_id.id,
+        }
+        if attachment_obj._storage(cr, uid, context=context) == 'db':
+            with open(export_file, 'rb') as f:
+                vals['datas'] = base64.b64encode(f.read())
+        else:
+            vals['store_fname'] = self._move_to_filestore(
+                cr, uid, export_file, context=context)
+        return attachment_obj.create(cr, uid, vals, context=context)
+
+    def export_account_analytic_lines(self, cr, uid, ids, context=None):
+        """Export the analytic lines to an attachment of the analytic
+        account, in CSV or JSON Lines. The lines are streamed to a file
+        moved in the filestore, keeping the memory flat whatever the number
+        of lines (see _store_export)."""
+        data = self.read(cr, uid, ids, [], context=context)[0]
+        wizard = self.browse(cr, uid, ids[0], context=context)
+        domain = self._get_lines_domain(cr, uid, data, context=context)
+        fd, export_file = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                rows = self._iter_export_rows(cr, uid, domain,
+                                              context=context)
+                self._write_export(cr, uid, rows, wizard.export_format, out,
+                                   context=context)
+            filename = 'analytic_lines_%s.%s' % (
+                (wizard.analytic_id.code or wizard.analytic_id.id),
+                wizard.export_format)
+            attachment_id = self._store_export(cr, uid, wizard, export_file,
+                                               filename, context=context)
+        finally:
+            if os.path.exists(export_file):
+                os.unlink(export_file)
+        return {
+            'type': 'ir.actions.act_url',
+            'url': '/web/binary/saveas?model=ir.attachment&field=datas'
+                   '&filename_field=datas_fname&id=%s' % attachment_id,
+            'target': 'self',
+        }
@@ -7,7 +7,7 @@
     'summary': """
         This module hides analytics lines from accounting menus and disable
          their generation from an invoice or a move line.""",
-    'version': '9.0.1.0.0',
+    'version': '9.0.1.3.0',
     'license': 'AGPL-3',
     'author': 'ACSONE SA/NV,Odoo Community Association (OCA)',
     'website': 'https://acsone.eu/',
@@ -16,8 +16,12 @@
         'analytic',
     ],
     'data': [
+        'security/ir.model.access.csv',
         'views/account_analytic_account.xml',
         'data/data_account_analytic_group.xml',
         'views/account_analytic.xml',
+        'views/res_company.xml',
+        'views/account_analytic_suppression_rule.xml',
+        'wizard/account_analytic_line_backfill.xml',
     ],
 }
@@ -1,2 +1,5 @@
+from . import account_analytic_line
+from . import account_analytic_suppression_rule
 from . import account_invoice
 from . import account_move_line
+from . import res_company
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 ACSONE SA/NV
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from openerp import api, fields, models
+from openerp.models import MAGIC_COLUMNS
+
+
+class AccountAnalyticLine(models.Model):
+
+    _inherit = 'account.analytic.line'
+
+    summary = fields.Boolean(
+        readonly=True,
+        help="Set on the analytic lines aggregating the journal items of "
+             "an analytic account, a financial account, a journal and a "
+             "month.")
+    summary_journal_id = fields.Many2one(
+        comodel_name='account.journal',
+        string='Summarized Journal',
+        readonly=True)
+    summary_account_id = fields.Many2one(
+        comodel_name='account.account',
+        string='Summarized Financial Account',
+        readonly=True)
+    general_account_id = fields.Many2one(
+        related=False,
+        compute='_compute_general_account_id',
+        store=True,
+        readonly=True)
+
+    @api.depends('move_id.account_id', 'summary_account_id')
+    def _compute_general_account_id(self):
+        # a summary line has no move line, its financial account is the
+        # one of the journal items it aggregates
+        for line in self:
+            line.general_account_id = (line.move_id.account_id or
+                                       line.summary_account_id)
+
+    def init(self, cr):
+        # the summary lines created before summary_account_id kept their
+        # financial account in general_account_id only
+        cr.execute("""
+            UPDATE account_analytic_line
+            SET summary_account_id = general_account_id
+            WHERE summary AND summary_account_id IS NULL""")
+        cr.execute("""
+            SELECT indexdef FROM pg_indexes
+            WHERE indexname = 'account_analytic_line_summary_index'""")
+        row = cr.fetchone()
+        if row and 'UNIQUE' not in row[0]:
+            cr.execute("DROP INDEX account_analytic_line_summary_index")
+            row = None
+        if not row:
+            cr.execute("""
+                CREATE UNIQUE INDEX account_analytic_line_summary_index
+                ON account_analytic_line
+                (account_id, general_account_id, summary_journal_id, date)
+                WHERE summary""")
+
+    @api.model
+    def _summary_key(self, vals, journal_id):
+        """ Return the key of the summary line in which the analytic line
+        described by ``vals`` has to be aggregated.
+        """
+        period = fields.Date.from_string(vals['date']).replace(day=1)
+        return (vals['account_id'], vals['general_account_id'], journal_id,
+                fields.Date.to_string(period))
+
+    @api.model
+    def _get_summary_lines(self, keys):
+        """ Return a dict mapping each summary key to the id of its summary
+        line. The missing summary lines are created with a zero amount.
+        """
+        if not keys:
+            return {}
+        # The transactions summarizing in the same summary lines are
+        # serialized, so two of them cannot create the same missing line,
+        # which the unique index would refuse
+        self.env.cr.execute(
+            "SELECT pg_advisory_xact_lock(hashtext(k)) "
+            "FROM unnest(%s::text[]) k",
+            (['account_analytic_line_summary-%s-%s-%s-%s' % key
+              for key in sorted(set(keys))],))
+        self.env.cr.execute("""
+            SELECT account_id, general_account_id, summary_journal_id, date,
+                   id
+            FROM account_analytic_line
+            WHERE summary
+            AND (account_id, general_account_id, summary_journal_id, date)
+                IN %s""", (tuple(keys),))
+        res = {}
+        for row in self.env.cr.fetchall():
+            res[row[:4]] = row[4]
+        journal_obj = self.env['account.journal']
+        for key in set(keys) - set(res):
+            account_id, general_account_id, journal_id, date = key
+            journal = journal_obj.browse(journal_id)
+            line = self.create({
+                'name': '%s %s' % (journal.code, date[:7]),
+                'date': date,
+                'account_id': account_id,
+                'summary': True,
+                'summary_journal_id': journal_id,
+                'summary_account_id': general_account_id,
+            })
+            res[key] = line.id
+        return res
+
+    @api.model
+    def _update_summary_amounts(self, totals):
+        """ Add the (amount, unit_amount) values of ``totals``, a dict keyed
+        by summary line id, to the summary lines.
+        """
+        for line_id, (amount, unit_amount) in totals.iteritems():
+            self.env.cr.execute("""
+                UPDATE account_analytic_line
+                SET amount = amount + %s, unit_amount = unit_amount + %s
+                WHERE id = %s""", (amount, unit_amount, line_id))
+        self.invalidate_cache(['amount', 'unit_amount'], totals.keys())
+
+    @api.model
+    def _bulk_create(self, vals_list):
+        """ Insert the analytic lines described by ``vals_list`` with a single
+        query, then recompute their stored computed fields.
+        """
+        if not vals_list:
+            return self.browse()
+        cr = self.env.cr
+        columns = [name for name, field in self._fields.iteritems()
+                   if field.store and not field.compute and
+                   field.type not in ('one2many', 'many2many') and
+                   name not in MAGIC_COLUMNS]
+        defaults = self.default_get(columns)
+        columns = [name for name in columns
+                   if name in defaults or
+                   any(name in vals for vals in vals_list)]
+        rows = []
+        for vals in vals_list:
+            row = [self.env.uid, self.env.uid]
+            for name in columns:
+                value = vals.get(name, defaults.get(name))
+                row.append(self._columns[name]._symbol_set[1](value))
+            rows.append(cr.mogrify(
+                '(%s, %s, now() at time zone \'UTC\', '
+                'now() at time zone \'UTC\', ' +
+                ', '.join(['%s'] * len(columns)) + ')', row))
+        cr.execute(
+            'INSERT INTO account_analytic_line '
+            '(create_uid, write_uid, create_date, write_date, ' +
+            ', '.join('"%s"' % name for name in columns) + ') '
+            'VALUES ' + ', '.join(rows) + ' RETURNING id')
+        ids = [row[0] for row in cr.fetchall()]
+        for name, field in self._fields.iteritems():
+            if field.type != 'many2many' or not field.store or field.compute:
+                continue
+            relation_rows = []
+            for line_id, vals in zip(ids, vals_list):
+                for command in vals.get(name) or []:
+                    if command[0] == 6:
+                        relation_rows += [(line_id, rel_id)
+                                          for rel_id in command[2]]
+                    elif command[0] == 4:
+                        relation_rows.append((line_id, command[1]))
+            if relation_rows:
+                cr.execute(
+                    'INSERT INTO "%s" ("%s", "%s") VALUES ' % (
+                        field.relation, field.column1, field.column2) +
+                    ', '.join(cr.mogrify('(%s, %s)', row)
+                              for row in relation_rows))
+        lines = self.browse(ids)
+        for field in self._fields.itervalues():
+            if field.store and field.compute:
+                self.env.add_todo(field, lines)
+        self.recompute()
+        return lines
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 ACSONE SA/NV
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from openerp import api, fields, models, tools
+
+
+def _compile_predicate(rules):
+    """ Return a function taking the journal id, the account id and the
+    absolute balance of a move line, and returning the id of the first
+    rule of ``rules`` matching it, or None.
+    """
+    def predicate(journal_id, account_id, amount):
+        for rule_id, journal_ids, account_ids, amount_max in rules:
+            if journal_ids and journal_id not in journal_ids:
+                continue
+            if account_ids and account_id not in account_ids:
+                continue
+            if amount_max and amount > amount_max:
+                continue
+            return rule_id
+        return None
+    return predicate
+
+
+class AccountAnalyticSuppressionRule(models.Model):
+
+    _name = 'account.analytic.suppression.rule'
+    _description = 'Analytic Line Suppression Rule'
+    _order = 'sequence, id'
+
+    @api.model
+    def _get_default_company(self):
+        return self.env['res.company']._company_default_get(
+            'account.analytic.suppression.rule')
+
+    name = fields.Char(required=True)
+    sequence = fields.Integer(default=10)
+    active = fields.Boolean(default=True)
+    company_id = fields.Many2one(
+        comodel_name='res.company',
+        string='Company',
+        required=True,
+        default=_get_default_company)
+    journal_ids = fields.Many2many(
+        comodel_name='account.journal',
+        string='Journals',
+        help="Leave empty to match the journal items of all the journals.")
+    account_ids = fields.Many2many(
+        comodel_name='account.account',
+        string='Accounts',
+        help="Leave empty to match the journal items of all the accounts.")
+    amount_max = fields.Float(
+        string='Maximum Amount',
+        help="Only match the journal items whose absolute balance is lower "
+             "or equal to this amount. Leave empty to match any amount.")
+    stat_ids = fields.One2many(
+        comodel_name='account.analytic.suppression.stat',
+        inverse_name='rule_id',
+        string='Statistics',
+        readonly=True)
+    suppressed_count = fields.Integer(
+        string='Suppressed Lines',
+        compute='_compute_suppressed_count')
+
+    @api.multi
+    def _compute_suppressed_count(self):
+        # the statistics are only readable by the account managers
+        stat_obj = self.env['account.analytic.suppression.stat'].sudo()
+        data = stat_obj.read_group(
+            [('rule_id', 'in', self.ids)], ['rule_id', 'line_count'],
+            ['rule_id'])
+        counts = dict((row['rule_id'][0], row['line_count']) for row in data)
+        for rule in self:
+            rule.suppressed_count = counts.get(rule.id, 0)
+
+    @api.model
+    @tools.ormcache('company_id')
+    def _get_predicate(self, company_id):
+        """ Return the compiled predicate of the active rules of a company.
+        """
+        rules = self.sudo().search([('company_id', '=', company_id)])
+        return _compile_predicate(tuple(
+            (rule.id, frozenset(rule.journal_ids.ids),
+             frozenset(rule.account_ids.ids), rule.amount_max)
+            for rule in rules))
+
+    @api.model
+    def create(self, vals):
+        self.clear_caches()
+        return super(AccountAnalyticSuppressionRule, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        self.clear_caches()
+        return super(AccountAnalyticSuppressionRule, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.clear_caches()
+        return super(AccountAnalyticSuppressionRule, self).unlink()
+
+
+class AccountAnalyticSuppressionStat(models.Model):
+
+    _name = 'account.analytic.suppression.stat'
+    _description = 'Suppressed Analytic Lines Statistics'
+    _order = 'date desc, id desc'
+
+    rule_id = fields.Many2one(
+        comodel_name='account.analytic.suppression.rule',
+        string='Rule',
+        required=True,
+        index=True,
+        ondelete='cascade')
+    date = fields.Date(
+        required=True,
+        default=fields.Date.context_today)
+    line_count = fields.Integer(string='Suppressed Lines')
+
+    @api.model
+    def _record(self, counts):
+        """ Record the number of suppressed lines per rule of a batch.
+        Statistics are only inserted so that concurrent postings don't
+        update the same rows.
+        """
+        for rule_id, line_count in counts.iteritems():
+            self.sudo().create({'rule_id': rule_id,
+                                'line_count': line_count})
@@ -2,13 +2,243 @@
 # Copyright 2016 ACSONE SA/NV
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-from openerp import api, models
+import logging
+import threading
+
+from openerp import api, fields, models
+
+_logger = logging.getLogger(__name__)
 
 
 class AccountMoveLine(models.Model):
 
     _inherit = 'account.move.line'
 
+    analytic_summary_id = fields.Many2one(
+        comodel_name='account.analytic.line',
+        string='Summary Analytic Line',
+        readonly=True,
+        copy=False,
+        index=True,
+        ondelete='set null')
+    analytic_summary_amount = fields.Float(
+        readonly=True,
+        copy=False,
+        help="Amount added to the summary analytic line.")
+    analytic_summary_unit_amount = fields.Float(
+        readonly=True,
+        copy=False,
+        help="Quantity added to the summary analytic line.")
+    analytic_suppression_rule_id = fields.Many2one(
+        comodel_name='account.analytic.suppression.rule',
+        string='Analytic Suppression Rule',
+        readonly=True,
+        copy=False,
+        ondelete='set null',
+        help="Rule which suppressed the analytic lines of the journal item "
+             "and counted it in its statistics.")
+
     @api.multi
     def create_analytic_lines(self):
-        pass
+        self.filtered('analytic_summary_id')._unsummarize_analytic_lines()
+        lines = self.filtered(
+            lambda l: l.company_id.analytic_line_mode != 'none')
+        suppressed = lines.filtered(
+            'analytic_account_id')._get_suppressed_analytic_lines()
+        if suppressed:
+            suppressed.mapped('analytic_line_ids').unlink()
+            lines -= suppressed
+        lines.filtered(
+            lambda l: l.analytic_account_id and
+            l.company_id.analytic_line_mode == 'summarized'
+        )._summarize_analytic_lines()
+        detailed = lines.filtered(
+            lambda l: l.company_id.analytic_line_mode == 'detailed')
+        if detailed:
+            super(AccountMoveLine, detailed).create_analytic_lines()
+
+    @api.multi
+    def unlink(self):
+        self.filtered('analytic_summary_id')._unsummarize_analytic_lines()
+        return super(AccountMoveLine, self).unlink()
+
+    @api.multi
+    def _get_suppressed_analytic_lines(self):
+        """ Return the lines matching a suppression rule of their company
+        and record how many lines each rule suppressed. The lines already
+        counted by the same rule, e.g. when their analytic lines are
+        created again, are not counted twice.
+        """
+        rule_obj = self.env['account.analytic.suppression.rule']
+        suppressed = self.browse()
+        counts = {}
+        rows = []
+        for company in self.mapped('company_id'):
+            predicate = rule_obj._get_predicate(company.id)
+            for line in self.filtered(lambda l: l.company_id == company):
+                rule_id = predicate(line.journal_id.id, line.account_id.id,
+                                    abs(line.debit - line.credit))
+                if rule_id:
+                    suppressed |= line
+                if (line.analytic_suppression_rule_id.id or None) == rule_id:
+                    continue
+                if rule_id:
+                    counts[rule_id] = counts.get(rule_id, 0) + 1
+                rows.append((line.id, rule_id))
+        if rows:
+            self._write_analytic_suppression(rows)
+        if counts:
+            self.env['account.analytic.suppression.stat']._record(counts)
+            _logger.debug("%d analytic lines suppressed", len(suppressed))
+        return suppressed
+
+    @api.model
+    def _write_analytic_suppression(self, rows):
+        """ Store the (move line id, suppression rule id) of ``rows`` with a
+        single query.
+        """
+        cr = self.env.cr
+        values = ','.join(cr.mogrify('(%s, %s::integer)', row)
+                          for row in rows)
+        cr.execute("""
+            UPDATE account_move_line AS aml
+            SET analytic_suppression_rule_id = v.rule_id
+            FROM (VALUES """ + values + """) AS v(id, rule_id)
+            WHERE aml.id = v.id""")
+        self.invalidate_cache(['analytic_suppression_rule_id'],
+                              [row[0] for row in rows])
+
+    @api.multi
+    def _summarize_analytic_lines(self):
+        """ Add the analytic amounts of the lines to their summary analytic
+        lines instead of creating one analytic line per move line.
+        """
+        if not self:
+            return
+        self.mapped('analytic_line_ids').unlink()
+        analytic_line_obj = self.env['account.analytic.line']
+        contributions = {}
+        for line in self:
+            vals = line._prepare_analytic_line()[0]
+            key = analytic_line_obj._summary_key(vals, line.journal_id.id)
+            contributions[line.id] = (key, vals['amount'],
+                                      vals['unit_amount'] or 0.0)
+        summary_ids = analytic_line_obj._get_summary_lines(
+            [key for key, amount, unit_amount in contributions.values()])
+        totals = {}
+        rows = []
+        for line_id, (key, amount, unit_amount) in contributions.iteritems():
+            summary_id = summary_ids[key]
+            total = totals.setdefault(summary_id, [0.0, 0.0])
+            total[0] += amount
+            total[1] += unit_amount
+            rows.append((line_id, summary_id, amount, unit_amount))
+        analytic_line_obj._update_summary_amounts(totals)
+        self._write_analytic_summary(rows)
+
+    @api.multi
+    def _unsummarize_analytic_lines(self):
+        """ Remove the contribution of the lines from their summary analytic
+        lines.
+        """
+        if not self:
+            return
+        totals = {}
+        for line in self:
+            total = totals.setdefault(line.analytic_summary_id.id, [0.0, 0.0])
+            total[0] -= line.analytic_summary_amount
+            total[1] -= line.analytic_summary_unit_amount
+        self.env['account.analytic.line']._update_summary_amounts(totals)
+        self._write_analytic_summary(
+            [(line_id, None, 0.0, 0.0) for line_id in self.ids])
+
+    @api.model
+    def _write_analytic_summary(self, rows):
+        """ Store the (move line id, summary line id, amount, unit amount)
+        contributions of ``rows`` with a single query.
+        """
+        cr = self.env.cr
+        values = ','.join(
+            cr.mogrify('(%s, %s::integer, %s::float, %s::float)', row)
+            for row in rows)
+        cr.execute("""
+            UPDATE account_move_line AS aml
+            SET analytic_summary_id = v.summary_id,
+                analytic_summary_amount = v.amount,
+                analytic_summary_unit_amount = v.unit_amount
+            FROM (VALUES """ + values + """)
+                AS v(id, summary_id, amount, unit_amount)
+            WHERE aml.id = v.id""")
+        self.invalidate_cache(
+            ['analytic_summary_id', 'analytic_summary_amount',
+             'analytic_summary_unit_amount'],
+            [row[0] for row in rows])
+
+    @api.model
+    def _backfill_analytic_lines(self, date_from, date_to, journal_ids=None,
+                                 chunk_size=1000, partition=0, partitions=1):
+        """ Create the missing analytic lines of the posted journal items
+        dated between ``date_from`` and ``date_to`` by chunks of
+        ``chunk_size`` lines, committing after each chunk.
+
+        The analytic lines are created as by ``create_analytic_lines``:
+        according to the analytic line mode of the company of the journal
+        items and to its suppression rules. The journal items which already
+        have analytic lines, or which are summarized or suppressed, are
+        skipped, so the backfill can be interrupted and run again. Only the
+        moves whose id modulo ``partitions`` equals ``partition`` are
+        processed, which allows running several backfills in parallel on
+        distinct cursors.
+
+        :return: the number of journal items processed
+        """
+        cr = self.env.cr
+        testing = getattr(threading.currentThread(), 'testing', False)
+        where_journal = ''
+        params = [date_from, date_to, partitions, partition]
+        if journal_ids:
+            where_journal = 'AND aml.journal_id IN %s'
+            params.append(tuple(journal_ids))
+        analytic_line_obj = self.env['account.analytic.line']
+        count = 0
+        last_id = 0
+        while True:
+            cr.execute("""
+                SELECT aml.id
+                FROM account_move_line aml
+                JOIN account_move am ON am.id = aml.move_id
+                JOIN res_company c ON c.id = aml.company_id
+                WHERE am.state = 'posted'
+                AND c.analytic_line_mode != 'none'
+                AND aml.analytic_account_id IS NOT NULL
+                AND aml.analytic_summary_id IS NULL
+                AND aml.analytic_suppression_rule_id IS NULL
+                AND aml.date >= %s AND aml.date <= %s
+                AND aml.move_id %% %s = %s
+                """ + where_journal + """
+                AND aml.id > %s
+                AND NOT EXISTS (SELECT 1 FROM account_analytic_line aal
+                                WHERE aal.move_id = aml.id)
+                ORDER BY aml.id
+                LIMIT %s""", params + [last_id, chunk_size])
+            line_ids = [row[0] for row in cr.fetchall()]
+            if not line_ids:
+                break
+            lines = self.browse(line_ids)
+            lines -= lines._get_suppressed_analytic_lines()
+            lines.filtered(
+                lambda l: l.company_id.analytic_line_mode == 'summarized'
+            )._summarize_analytic_lines()
+            analytic_line_obj._bulk_create(
+                [vals for line in lines.filtered(
+                    lambda l: l.company_id.analytic_line_mode == 'detailed')
+                 for vals in line._prepare_analytic_line()])
+            count += len(line_ids)
+            last_id = line_ids[-1]
+            if not testing:
+                cr.commit()
+            self.invalidate_cache()
+            _logger.info("Analytic lines backfill %d/%d: %d journal items "
+                         "processed",
+                         partition + 1, partitions, count)
+        return count
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 ACSONE SA/NV
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from openerp import fields, models
+
+
+class ResCompany(models.Model):
+
+    _inherit = 'res.company'
+
+    analytic_line_mode = fields.Selection(
+        [('none', 'No analytic lines'),
+         ('summarized', 'Summarized analytic lines'),
+         ('detailed', 'Detailed analytic lines')],
+        string='Analytic Lines',
+        required=True,
+        default='none',
+        help="Defines which analytic lines are generated when posting "
+             "journal entries.\n"
+             "* No analytic lines: no analytic line is created.\n"
+             "* Summarized analytic lines: one analytic line is maintained "
+             "per analytic account, financial account, journal and month.\n"
+             "* Detailed analytic lines: one analytic line is created per "
+             "journal item.\n"
+             "In the last two modes, no analytic line is generated for the "
+             "journal items matching a suppression rule.")
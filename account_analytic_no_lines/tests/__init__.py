@@ -1 +1,4 @@
 from . import test_account_analytic_no_lines
+from . import test_account_analytic_summary
+from . import test_account_analytic_suppression
+from . import test_account_analytic_backfill
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 ACSONE SA/NV
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from openerp.tests.common import SavepointCase
+
+
+class TestAccountAnalyticBackfill(SavepointCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestAccountAnalyticBackfill, cls).setUpClass()
+
+        # ENVIRONMENTS
+
+        cls.account_account = cls.env['account.account']
+        cls.account_journal = cls.env['account.journal']
+        cls.account_move = cls.env['account.move']
+        cls.account_move_line = cls.env['account.move.line']
+
+        # INSTANCES
+
+        # Instance: analytic account
+        cls.analytic_account = cls.env['account.analytic.account'].create({
+            'name': 'Backfilled analytic account'})
+
+        # Instance: accounts
+        cls.account_550001 = cls.account_account.create({
+            'name': 'Banque',
+            'code': '550001_demo',
+            'user_type_id':
+                cls.env.ref('account.data_account_type_liquidity').id,
+            'reconcile': False})
+        cls.account_600000 = cls.account_account.create({
+            'name': 'Achats de matières premières',
+            'code': '600000_demo',
+            'user_type_id':
+                cls.env.ref('account.data_account_type_expenses').id,
+            'reconcile': False})
+
+        # Journal
+        cls.journal = cls.account_journal.create({
+            'name': 'Bank Journal Test',
+            'type': 'bank',
+            'code': 'BKTEST',
+            'default_debit_account_id': cls.account_550001.id,
+            'default_credit_account_id': cls.account_550001.id})
+
+        # Moves, posted without analytic lines
+        cls.moves = cls.account_move.browse()
+        for amount in (100, 50, 25):
+            move = cls.account_move.create({
+                'journal_id': cls.journal.id,
+                'date': '2016-01-15',
+                'line_ids': [
+                    (0, 0, {'name': 'Expense',
+                            'account_id': cls.account_600000.id,
+                            'analytic_account_id': cls.analytic_account.id,
+                            'quantity': 1,
+                            'debit': amount}),
+                    (0, 0, {'name': 'Bank',
+                            'account_id': cls.account_550001.id,
+                            'credit': amount}),
+                ]})
+            move.post()
+            cls.moves |= move
+
+        # Analytic lines generated from now on
+        cls.env.user.company_id.analytic_line_mode = 'detailed'
+
+    def _backfill(self, **kwargs):
+        return self.account_move_line._backfill_analytic_lines(
+            '2016-01-01', '2016-01-31', journal_ids=[self.journal.id],
+            **kwargs)
+
+    def test_backfill(self):
+        """
+        Test that the backfill creates the missing analytic lines, by
+        chunks, and that running it again creates nothing.
+        """
+        self.assertFalse(self.moves.mapped('line_ids.analytic_line_ids'))
+        self.assertEqual(self._backfill(chunk_size=2), 3)
+        analytic_lines = self.moves.mapped('line_ids.analytic_line_ids')
+        self.assertEqual(len(analytic_lines), 3)
+        self.assertEqual(analytic_lines.mapped('general_account_id'),
+                         self.account_600000)
+        self.assertAlmostEqual(sum(analytic_lines.mapped('amount')), -175)
+        self.assertEqual(self._backfill(), 0)
+
+    def test_backfill_partitions(self):
+        """
+        Test that the partitions of a backfill cover all the journal items
+        once.
+        """
+        count = sum(self._backfill(partition=partition, partitions=2)
+                    for partition in range(2))
+        self.assertEqual(count, 3)
+        self.assertEqual(
+            len(self.moves.mapped('line_ids.analytic_line_ids')), 3)
+
+    def test_backfill_summarized(self):
+        """
+        Test that the backfill summarizes the journal items of the companies
+        in summarized mode, and skips the ones in no analytic lines mode.
+        """
+        company = self.env.user.company_id
+        company.analytic_line_mode = 'none'
+        self.assertEqual(self._backfill(), 0)
+        company.analytic_line_mode = 'summarized'
+        self.assertEqual(self._backfill(), 3)
+        summary = self.env['account.analytic.line'].search([
+            ('account_id', '=', self.analytic_account.id)])
+        self.assertEqual(len(summary), 1)
+        self.assertTrue(summary.summary)
+        self.assertAlmostEqual(summary.amount, -175)
+        self.assertEqual(self._backfill(), 0)
+
+    def test_backfill_suppressed(self):
+        """
+        Test that the backfill applies the suppression rules.
+        """
+        self.env['account.analytic.suppression.rule'].create({
+            'name': 'Small amounts',
+            'journal_ids': [(6, 0, [self.journal.id])],
+            'amount_max': 60})
+        self.assertEqual(self._backfill(), 3)
+        analytic_lines = self.moves.mapped('line_ids.analytic_line_ids')
+        self.assertAlmostEqual(sum(analytic_lines.mapped('amount')), -100)
+        self.assertEqual(self._backfill(), 0)
+
+    def test_backfill_wizard(self):
+        """
+        Test that the wizard schedules one backfill per worker instead of
+        running it.
+        """
+        wizard = self.env['account.analytic.line.backfill'].create({
+            'date_from': '2016-01-01',
+            'date_to': '2016-01-31',
+            'journal_ids': [(6, 0, [self.journal.id])],
+            'workers': 2})
+        wizard.action_backfill()
+        crons = self.env['ir.cron'].search([
+            ('model', '=', 'account.move.line'),
+            ('function', '=', '_backfill_analytic_lines')])
+        self.assertEqual(len(crons), 2)
+        self.assertEqual(crons.mapped('numbercall'), [1, 1])
+        self.assertFalse(self.moves.mapped('line_ids.analytic_line_ids'))
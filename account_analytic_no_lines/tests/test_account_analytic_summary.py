@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 ACSONE SA/NV
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from openerp.tests.common import SavepointCase
+
+
+class TestAccountAnalyticSummary(SavepointCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestAccountAnalyticSummary, cls).setUpClass()
+
+        # ENVIRONMENTS
+
+        cls.account_account = cls.env['account.account']
+        cls.account_analytic_line = cls.env['account.analytic.line']
+        cls.account_journal = cls.env['account.journal']
+        cls.account_move = cls.env['account.move']
+
+        # INSTANCES
+
+        cls.env.user.company_id.analytic_line_mode = 'summarized'
+
+        # Instance: analytic account
+        cls.analytic_account = cls.env['account.analytic.account'].create({
+            'name': 'Summarized analytic account'})
+
+        # Instance: accounts
+        cls.account_550001 = cls.account_account.create({
+            'name': 'Banque',
+            'code': '550001_demo',
+            'user_type_id':
+                cls.env.ref('account.data_account_type_liquidity').id,
+            'reconcile': False})
+        cls.account_600000 = cls.account_account.create({
+            'name': 'Achats de matières premières',
+            'code': '600000_demo',
+            'user_type_id':
+                cls.env.ref('account.data_account_type_expenses').id,
+            'reconcile': False})
+
+        # Journal
+        cls.journal = cls.account_journal.create({
+            'name': 'Bank Journal Test',
+            'type': 'bank',
+            'code': 'BKTEST',
+            'update_posted': True,
+            'default_debit_account_id': cls.account_550001.id,
+            'default_credit_account_id': cls.account_550001.id})
+
+    def _create_move(self, amount, date='2016-01-15'):
+        move = self.account_move.create({
+            'journal_id': self.journal.id,
+            'date': date,
+            'line_ids': [
+                (0, 0, {'name': 'Expense',
+                        'account_id': self.account_600000.id,
+                        'analytic_account_id': self.analytic_account.id,
+                        'quantity': 1,
+                        'debit': amount}),
+                (0, 0, {'name': 'Bank',
+                        'account_id': self.account_550001.id,
+                        'credit': amount}),
+            ]})
+        move.post()
+        return move
+
+    def _get_summary_lines(self):
+        return self.account_analytic_line.search([
+            ('account_id', '=', self.analytic_account.id)])
+
+    def test_summarized_lines(self):
+        """
+        Test that the moves of a same journal, account and month are
+        aggregated in one analytic line.
+        """
+        move_1 = self._create_move(100)
+        self._create_move(50, date='2016-01-20')
+        summary = self._get_summary_lines()
+        self.assertEqual(len(summary), 1)
+        self.assertTrue(summary.summary)
+        self.assertEqual(summary.date, '2016-01-01')
+        self.assertEqual(summary.general_account_id, self.account_600000)
+        self.assertEqual(summary.summary_journal_id, self.journal)
+        self.assertAlmostEqual(summary.amount, -150)
+        self.assertAlmostEqual(summary.unit_amount, 2)
+        self.assertFalse(move_1.line_ids.mapped('analytic_line_ids'))
+        # the financial account survives a recompute of the field
+        self.env.add_todo(summary._fields['general_account_id'], summary)
+        summary.recompute()
+        self.assertEqual(summary.general_account_id, self.account_600000)
+
+        self._create_move(25, date='2016-02-01')
+        self.assertEqual(len(self._get_summary_lines()), 2)
+        self.assertAlmostEqual(self.analytic_account.balance, -175)
+
+    def test_summarized_lines_unlink(self):
+        """
+        Test that deleting a move removes its amount from the summary line.
+        """
+        move = self._create_move(100)
+        self._create_move(50)
+        move.button_cancel()
+        move.unlink()
+        summary = self._get_summary_lines()
+        self.assertAlmostEqual(summary.amount, -50)
+        self.assertAlmostEqual(summary.unit_amount, 1)
+
+    def test_summarized_lines_repost(self):
+        """
+        Test that posting a move again doesn't count it twice.
+        """
+        move = self._create_move(100)
+        move.button_cancel()
+        move.post()
+        summary = self._get_summary_lines()
+        self.assertAlmostEqual(summary.amount, -100)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 ACSONE SA/NV
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from openerp.tests.common import SavepointCase
+
+
+class TestAccountAnalyticSuppression(SavepointCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestAccountAnalyticSuppression, cls).setUpClass()
+
+        # ENVIRONMENTS
+
+        cls.account_account = cls.env['account.account']
+        cls.account_journal = cls.env['account.journal']
+        cls.account_move = cls.env['account.move']
+        cls.suppression_rule = cls.env['account.analytic.suppression.rule']
+
+        # INSTANCES
+
+        cls.env.user.company_id.analytic_line_mode = 'detailed'
+
+        # Instance: analytic account
+        cls.analytic_account = cls.env['account.analytic.account'].create({
+            'name': 'Detailed analytic account'})
+
+        # Instance: accounts
+        cls.account_550001 = cls.account_account.create({
+            'name': 'Banque',
+            'code': '550001_demo',
+            'user_type_id':
+                cls.env.ref('account.data_account_type_liquidity').id,
+            'reconcile': False})
+        cls.account_600000 = cls.account_account.create({
+            'name': 'Achats de matières premières',
+            'code': '600000_demo',
+            'user_type_id':
+                cls.env.ref('account.data_account_type_expenses').id,
+            'reconcile': False})
+
+        # Journals
+        cls.journal_fees = cls.account_journal.create({
+            'name': 'Bank Fees Journal Test',
+            'type': 'bank',
+            'code': 'BKFEES',
+            'default_debit_account_id': cls.account_550001.id,
+            'default_credit_account_id': cls.account_550001.id})
+        cls.journal_project = cls.account_journal.create({
+            'name': 'Project Journal Test',
+            'type': 'general',
+            'code': 'PRJTEST'})
+
+        # Rule
+        cls.rule = cls.suppression_rule.create({
+            'name': 'Bank fees',
+            'journal_ids': [(6, 0, [cls.journal_fees.id])],
+            'amount_max': 100})
+
+    def _create_move(self, journal, amount):
+        move = self.account_move.create({
+            'journal_id': journal.id,
+            'line_ids': [
+                (0, 0, {'name': 'Expense',
+                        'account_id': self.account_600000.id,
+                        'analytic_account_id': self.analytic_account.id,
+                        'debit': amount}),
+                (0, 0, {'name': 'Bank',
+                        'account_id': self.account_550001.id,
+                        'credit': amount}),
+            ]})
+        move.post()
+        return move
+
+    def test_suppressed_journal(self):
+        """
+        Test that no analytic line is created for the journal items matching
+        a rule and that they are counted on the rule.
+        """
+        move = self._create_move(self.journal_fees, 10)
+        self.assertFalse(move.line_ids.mapped('analytic_line_ids'))
+        self.assertEqual(self.rule.suppressed_count, 1)
+
+    def test_not_suppressed_journal(self):
+        """
+        Test that the analytic lines are created for the journal items not
+        matching a rule.
+        """
+        move = self._create_move(self.journal_project, 10)
+        self.assertEqual(len(move.line_ids.mapped('analytic_line_ids')), 1)
+        self.assertEqual(self.rule.suppressed_count, 0)
+
+    def test_amount_threshold(self):
+        """
+        Test that the journal items above the maximum amount of a rule are
+        not suppressed, and that rule changes are taken into account.
+        """
+        move = self._create_move(self.journal_fees, 500)
+        self.assertEqual(len(move.line_ids.mapped('analytic_line_ids')), 1)
+        self.rule.amount_max = 0.0
+        move = self._create_move(self.journal_fees, 500)
+        self.assertFalse(move.line_ids.mapped('analytic_line_ids'))
+
+    def test_suppressed_counted_once(self):
+        """
+        Test that creating the analytic lines of suppressed journal items
+        again doesn't count them again, and that account users can read
+        the count.
+        """
+        move = self._create_move(self.journal_fees, 10)
+        move.line_ids.create_analytic_lines()
+        self.assertEqual(self.rule.suppressed_count, 1)
+        self.assertEqual(
+            move.line_ids.mapped('analytic_suppression_rule_id'), self.rule)
+        user = self.env['res.users'].create({
+            'name': 'Account User',
+            'login': 'analytic_suppression_user',
+            'groups_id': [
+                (6, 0, [self.env.ref('account.group_account_user').id])],
+        })
+        self.assertEqual(self.rule.sudo(user).suppressed_count, 1)
@@ -0,0 +1 @@
+from . import account_analytic_line_backfill
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 ACSONE SA/NV
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from openerp import _, api, fields, models
+from openerp.exceptions import UserError
+
+
+class AccountAnalyticLineBackfill(models.TransientModel):
+
+    _name = 'account.analytic.line.backfill'
+    _description = 'Analytic Lines Backfill'
+
+    date_from = fields.Date(required=True)
+    date_to = fields.Date(required=True)
+    journal_ids = fields.Many2many(
+        comodel_name='account.journal',
+        string='Journals',
+        help="Leave empty to backfill the journal items of all the journals.")
+    chunk_size = fields.Integer(
+        required=True,
+        default=1000,
+        help="Number of journal items processed and committed at once.")
+    workers = fields.Integer(
+        required=True,
+        default=1,
+        help="Number of scheduled actions backfilling the analytic lines "
+             "in parallel, each on its own share of the journal entries.")
+
+    @api.multi
+    def action_backfill(self):
+        self.ensure_one()
+        if self.chunk_size < 1 or self.workers < 1:
+            raise UserError(
+                _("The chunk size and the number of workers must be "
+                  "positive."))
+        # The backfill can take hours, so it is run by one-time scheduled
+        # actions, which have their own cursors and can commit, instead of
+        # the request
+        cron_obj = self.env['ir.cron'].sudo()
+        for partition in range(self.workers):
+            cron_obj.create({
+                'name': _('Analytic Lines Backfill %d/%d') % (
+                    partition + 1, self.workers),
+                'user_id': self.env.uid,
+                'model': 'account.move.line',
+                'function': '_backfill_analytic_lines',
+                'args': repr((self.date_from, self.date_to,
+                              self.journal_ids.ids, self.chunk_size,
+                              partition, self.workers)),
+                'interval_number': 1,
+                'interval_type': 'minutes',
+                'numbercall': 1,
+                'doall': False,
+                'nextcall': fields.Datetime.now(),
+            })
+        return {'type': 'ir.actions.act_window_close'}
@@ -19,6 +19,11 @@
 #
 ##############################################################################
 
+from . import account_account
 from . import account_analytic_line
 from . import analytic
 from . import analytic_analysis
+from . import res_currency
+from . import res_currency_rate_daily
+from . import analytic_currency_job
+from . import account_analytic_revaluation
@@ -29,7 +29,9 @@
                 "analytic",
                 "account_analytic_analysis",
                 ],
-    "data": ["analytic_view.xml",
+    "data": ["security/ir.model.access.csv",
+             "analytic_view.xml",
+             "data/ir_cron.xml",
              ],
     'installable': False
 }
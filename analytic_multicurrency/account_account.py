@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Author: Joël Grand-Guillaume
+#    Copyright 2010-2013 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+from openerp.osv import orm
+
+
+class account_account(orm.Model):
+    _inherit = 'account.account'
+
+    def write(self, cr, uid, ids, vals, context=None):
+        res = super(account_account, self).write(cr, uid, ids, vals,
+                                                 context=context)
+        if 'company_id' in vals:
+            if isinstance(ids, (int, long)):
+                ids = [ids]
+            self.pool['account.analytic.line']._update_company(
+                cr, uid, ids, context=context)
+        return res
@@ -19,34 +19,33 @@
 #
 ##############################################################################
 
+from openerp import SUPERUSER_ID
 from openerp.osv import orm, fields
 import openerp.addons.decimal_precision as dp
+from openerp.tools.translate import _
 
 
 class account_analytic_line(orm.Model):
     _inherit = 'account.analytic.line'
 
     def _amount_currency(self, cr, uid, ids, field_name, arg, context=None):
-        if context is None:
-            context = {}
         result = {}
         cur_obj = self.pool.get('res.currency')
+        to_convert = []
         for line in self.browse(cr, uid, ids, context=context):
             cmp_cur_id = line.company_id.currency_id.id
             aa_cur_id = line.account_id.currency_id.id
             # Always provide the amount in currency
             if cmp_cur_id == aa_cur_id:
                 result[line.id] = line.amount
-            else:
-                ctx = context.copy()
-                if not (line.date and line.amount):
-                    continue
-                ctx['date'] = line.date
-                result[line.id] = cur_obj.compute(cr, uid,
-                                                  cmp_cur_id,
-                                                  aa_cur_id,
-                                                  line.amount,
-                                                  context=ctx)
+            elif line.date and line.amount:
+                to_convert.append((line.id, (cmp_cur_id, aa_cur_id,
+                                             line.date, line.amount)))
+        # Convert all the amounts at once, each rate being read only once
+        amounts = cur_obj.compute_batch(
+            cr, uid, [item for line_id, item in to_convert], context=context)
+        for (line_id, item), amount in zip(to_convert, amounts):
+            result[line_id] = amount
         return result
 
     def _get_account_currency(self, cr, uid, ids, field_name, arg,
@@ -58,16 +57,15 @@ class account_analytic_line(orm.Model):
                                line.account_id.currency_id.name)
         return result
 
-    def _get_account_line(self, cr, uid, ids, context=None):
-        aa_line_obj = self.pool.get('account.analytic.line')
-        return aa_line_obj.search(cr, uid,
-                                  [('account_id', 'in', ids)],
-                                  context=context)
-
     # Add the account currency and amount in this currency on each
     # analytic line.
-    # The company_id of analytic line is always related to the company
-    # of the general account linked on the line
+    # The company_id of analytic line is always the company of the general
+    # account linked on the line. It is maintained by the create and write
+    # of the lines and of the general accounts instead of a stored related
+    # field, which is recomputed through the ORM.
+    # When the currency or the company of an analytic account changes, its
+    # lines are recomputed by account.analytic.account.write, or by an
+    # account.analytic.currency.job for the accounts having many lines
     _columns = {
         'aa_currency_id': fields.function(
             _get_account_currency,
@@ -75,9 +73,6 @@ class account_analytic_line(orm.Model):
             relation='res.currency',
             string='Analytic Account currency',
             store={
-                'account.analytic.account': (_get_account_line,
-                                             ['currency_id', 'company_id'],
-                                             50),
                 'account.analytic.line': (lambda self, cr, uid, ids, c=None:
                                           ids,
                                           ['amount',
@@ -91,9 +86,6 @@ class account_analytic_line(orm.Model):
             string='Analytic Amount currency',
             digits_compute=dp.get_precision('Account'),
             store={
-                'account.analytic.account': (_get_account_line,
-                                             ['currency_id', 'company_id'],
-                                             50),
                 'account.analytic.line': (lambda self, cr, uid, ids, c=None:
                                           ids,
                                           ['amount',
@@ -103,25 +95,425 @@ class account_analytic_line(orm.Model):
             },
             help="The amount expressed in the related analytic account "
                  "currency."),
-        'company_id': fields.related(
-            'general_account_id',
-            'company_id',
-            type='many2one',
-            relation='res.company',
-            string='Company',
-            store=True,
+        'company_id': fields.many2one(
+            'res.company',
+            'Company',
             readonly=True),
     }
 
-    def on_change_unit_amount(self, cr, uid, ids, prod_id, quantity,
-                              company_id, unit=False, journal_id=False,
-                              context=None):
+    def init(self, cr):
+        # Set the company of the general account on the lines, with one
+        # statement per company
+        cr.execute("SELECT id FROM res_company")
+        for company_id, in cr.fetchall():
+            cr.execute("""
+                UPDATE account_analytic_line l
+                SET company_id = %s
+                FROM account_account a
+                WHERE a.id = l.general_account_id
+                AND a.company_id = %s
+                AND l.company_id IS DISTINCT FROM %s""",
+                       (company_id, company_id, company_id))
+
+    def _get_pricing_contexts(self, cr, uid, company_ids, context=None):
+        """Return a dict mapping each company id to the context in which
+        the products are priced for this company, i.e. in its currency"""
         if context is None:
             context = {}
         company_obj = self.pool.get('res.company')
-        company = company_obj.browse(cr, uid, company_id, context=context)
-        ctx = context.copy()
-        ctx['currency_id'] = company.currency_id.id
+        currencies = dict.fromkeys(company_ids, False)
+        for company in company_obj.browse(
+                cr, uid, [company_id for company_id in currencies
+                          if company_id], context=context):
+            currencies[company.id] = company.currency_id.id
+        res = {}
+        for company_id, currency_id in currencies.iteritems():
+            ctx = context.copy()
+            ctx['currency_id'] = currency_id
+            res[company_id] = ctx
+        return res
+
+    def on_change_unit_amount(self, cr, uid, ids, prod_id, quantity,
+                              company_id, unit=False, journal_id=False,
+                              context=None):
+        ctx = self._get_pricing_contexts(cr, uid, [company_id],
+                                         context=context)[company_id]
         return super(account_analytic_line, self).on_change_unit_amount(
             cr, uid, ids, prod_id, quantity, company_id,
             unit=unit, journal_id=journal_id, context=ctx)
+
+    def _get_batch_pricing(self, cr, uid, keys, context=None):
+        """Return a dict mapping each (product id, uom id, company id,
+        journal id) of keys to the (unit price, sign, general account id,
+        uom id) with which the analytic lines of this
+        key are priced, as on_change_unit_amount does, or to None if they
+        cannot be priced. The products, units, journals and prices are
+        read once per batch."""
+        if context is None:
+            context = {}
+        journal_obj = self.pool.get('account.analytic.journal')
+        product_obj = self.pool.get('product.product')
+        uom_obj = self.pool.get('product.uom')
+        price_type_obj = self.pool.get('product.price.type')
+        default_journal_id = False
+        if any(not key[3] for key in keys):
+            journal_ids = journal_obj.search(cr, uid,
+                                             [('type', '=', 'purchase')])
+            default_journal_id = journal_ids and journal_ids[0] or False
+        keys = dict((key, key[:3] + (key[3] or default_journal_id,))
+                    for key in keys)
+        journal_types = dict(
+            (journal.id, journal.type) for journal in journal_obj.browse(
+                cr, uid, list(set(key[3] for key in keys.itervalues()
+                                  if key[3])), context=context))
+        products = dict(
+            (product.id, product) for product in product_obj.browse(
+                cr, uid, list(set(key[0] for key in keys.itervalues()
+                                  if key[0])), context=context))
+        units = dict(
+            (unit.id, unit) for unit in uom_obj.browse(
+                cr, uid, list(set(key[1] for key in keys.itervalues()
+                                  if key[1])), context=context))
+        price_type_ids = price_type_obj.search(
+            cr, uid, [('field', '=', 'standard_price')], context=context)
+        cost_field = price_type_obj.browse(
+            cr, uid, price_type_ids[0], context=context).field
+        sale_field = cost_field
+        if 'sale' in journal_types.values():
+            price_type_ids = price_type_obj.search(
+                cr, uid, [('field', '=', 'list_price')], context=context)
+            if price_type_ids:
+                sale_field = price_type_obj.browse(
+                    cr, uid, price_type_ids[0], context=context).field
+        contexts = self._get_pricing_contexts(
+            cr, uid, [key[2] for key in keys.itervalues()], context=context)
+        res = {}
+        to_price = {}
+        for key, (prod_id, unit, company_id, journal_id) in keys.iteritems():
+            if not journal_id or not prod_id:
+                res[key] = None
+                continue
+            prod = products[prod_id]
+            journal_type = journal_types[journal_id]
+            unit_obj = units.get(unit)
+            if not unit_obj or \
+                    prod.uom_id.category_id.id != unit_obj.category_id.id:
+                unit = prod.uom_id.id
+            if journal_type == 'purchase':
+                if not unit_obj or \
+                        prod.uom_po_id.category_id.id != \
+                        unit_obj.category_id.id:
+                    unit = prod.uom_po_id.id
+            if journal_type != 'sale':
+                account_id = prod.property_account_expense.id or \
+                    prod.categ_id.property_account_expense_categ.id
+                field = cost_field
+                message = _('There is no expense account defined '
+                            'for this product: "%s" (id:%d).')
+            else:
+                account_id = prod.property_account_income.id or \
+                    prod.categ_id.property_account_income_categ.id
+                field = sale_field
+                message = _('There is no income account defined '
+                            'for this product: "%s" (id:%d).')
+            if not account_id:
+                raise orm.except_orm(_('Error!'),
+                                     message % (prod.name, prod.id))
+            sign = field == 'list_price' and 1 or -1
+            res[key] = [0.0, sign, account_id, unit]
+            to_price.setdefault((company_id, field, unit), []).append(key)
+        for (company_id, field, unit), price_keys in to_price.iteritems():
+            ctx = dict(contexts[company_id], uom=unit)
+            prices = product_obj.price_get(
+                cr, uid, list(set(key[0] for key in price_keys)),
+                ptype=field, context=ctx)
+            for key in price_keys:
+                res[key][0] = prices.get(key[0]) or 0.0
+        return res
+
+    def compute_amounts_batch(self, cr, uid, items, context=None):
+        """Price many analytic lines at once, e.g. when importing
+        timesheets.
+
+        The unit prices, units and general accounts are computed once per
+        product, unit, company and journal, with the prices of the products
+        read together (see _get_batch_pricing), then the amount of each
+        line is its unit price times its quantity, so the result is the one
+        of on_change_unit_amount without calling it for each line.
+
+        :param items: list of (product id, quantity, uom id, company id,
+                      journal id) tuples
+        :return: the list of the values returned by on_change_unit_amount
+                 for each item (amount, general_account_id and
+                 product_uom_id), or an empty dict if it cannot be priced
+
+        When on_change_unit_amount is overridden by a module installed
+        after this one, the batch pricing could not give its result, so it
+        is called for each line instead.
+        """
+        if self._is_onchange_overridden():
+            res = []
+            for prod_id, quantity, unit, company_id, journal_id in items:
+                onchange = self.on_change_unit_amount(
+                    cr, uid, [], prod_id, quantity, company_id, unit=unit,
+                    journal_id=journal_id, context=context)
+                res.append(onchange.get('value', {}))
+            return res
+        precision = self.pool.get('decimal.precision').precision_get(
+            cr, uid, 'Account')
+        pricing = self._get_batch_pricing(
+            cr, uid, set((item[0], item[2], item[3], item[4])
+                         for item in items), context=context)
+        res = []
+        for prod_id, quantity, unit, company_id, journal_id in items:
+            key = (prod_id, unit, company_id, journal_id)
+            if pricing[key] is None:
+                res.append({})
+                continue
+            price, sign, account_id, unit_id = pricing[key]
+            amount = round(price * quantity or 0.0, precision)
+            res.append({
+                'amount': amount * sign,
+                'general_account_id': account_id,
+                'product_uom_id': unit_id,
+            })
+        return res
+
+    def _is_onchange_overridden(self):
+        """Return whether on_change_unit_amount is overridden by a class
+        inheriting from this one, which _get_batch_pricing does not know"""
+        for cls in type(self).__mro__:
+            if 'on_change_unit_amount' in vars(cls):
+                return cls is not account_analytic_line
+        return False
+
+    def _clear_sums_cache(self, cr):
+        self.pool['account.analytic.account'].clear_sums_cache(cr)
+
+    def _add_company_vals(self, cr, uid, vals, context=None):
+        """Return vals with the company of the general account"""
+        if 'general_account_id' not in vals:
+            return vals
+        company_id = False
+        if vals['general_account_id']:
+            cr.execute("SELECT company_id FROM account_account WHERE id = %s",
+                       (vals['general_account_id'],))
+            company_id = cr.fetchone()[0]
+        return dict(vals, company_id=company_id)
+
+    def create(self, cr, uid, vals, context=None):
+        self._clear_sums_cache(cr)
+        vals = self._add_company_vals(cr, uid, vals, context=context)
+        return super(account_analytic_line, self).create(
+            cr, uid, vals, context=context)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        self._clear_sums_cache(cr)
+        vals = self._add_company_vals(cr, uid, vals, context=context)
+        return super(account_analytic_line, self).write(
+            cr, uid, ids, vals, context=context)
+
+    def _update_company(self, cr, uid, general_account_ids, chunk_size=10000,
+                        context=None):
+        """Set the company of their general account on the lines of the
+        general accounts, by chunks of lines, and recompute their amounts
+        in currency"""
+        if not general_account_ids:
+            return
+        last_line_id = 0
+        while True:
+            cr.execute("""
+                SELECT id FROM account_analytic_line
+                WHERE general_account_id IN %s AND id > %s
+                ORDER BY id LIMIT %s""",
+                       (tuple(general_account_ids), last_line_id, chunk_size))
+            line_ids = [row[0] for row in cr.fetchall()]
+            if not line_ids:
+                break
+            last_line_id = line_ids[-1]
+            cr.execute("""
+                UPDATE account_analytic_line l
+                SET company_id = a.company_id
+                FROM account_account a
+                WHERE a.id = l.general_account_id
+                AND l.company_id IS DISTINCT FROM a.company_id
+                AND l.id IN %s
+                RETURNING l.id""", (tuple(line_ids),))
+            updated_ids = [row[0] for row in cr.fetchall()]
+            if updated_ids:
+                self.invalidate_cache(cr, uid, ['company_id'], updated_ids,
+                                      context=context)
+                self._clear_sums_cache(cr)
+                self._compute_amount_currency_sql(cr, uid, updated_ids,
+                                                  context=context)
+
+    def unlink(self, cr, uid, ids, context=None):
+        self._clear_sums_cache(cr)
+        return super(account_analytic_line, self).unlink(
+            cr, uid, ids, context=context)
+
+    def _store_set_values(self, cr, uid, ids, fields, context=None):
+        # also called for the stored fields recomputed by other models
+        res = super(account_analytic_line, self)._store_set_values(
+            cr, uid, ids, fields, context=context)
+        self._clear_sums_cache(cr)
+        return res
+
+    def _compute_amount_currency_sql(self, cr, uid, ids, context=None):
+        """Store aa_currency_id and aa_amount_currency of the lines with
+        set-based queries converting the amounts with the daily rates.
+
+        The lines which cannot be converted in SQL (e.g. missing rate) are
+        computed by ``_amount_currency``, the rates and the rounding used in
+        SQL being the ones of ``res.currency.compute``.
+        """
+        if not ids:
+            return
+        ids = tuple(ids)
+        cr.execute("SELECT max(date) FROM account_analytic_line "
+                   "WHERE id IN %s", (ids,))
+        max_date = cr.fetchone()[0]
+        if max_date:
+            self.pool['res.currency.rate.daily'].extend(cr, max_date)
+        cr.execute("""
+            UPDATE account_analytic_line l
+            SET aa_currency_id = a.currency_id,
+                aa_amount_currency = l.amount
+            FROM account_analytic_account a, res_company c
+            WHERE a.id = l.account_id
+            AND c.id = l.company_id
+            AND c.currency_id = a.currency_id
+            AND l.id IN %s
+            RETURNING l.id""", (ids,))
+        done_ids = set(row[0] for row in cr.fetchall())
+        cr.execute("""
+            UPDATE account_analytic_line l
+            SET aa_currency_id = a.currency_id,
+                aa_amount_currency = round(l.amount * (dt.rate / df.rate)
+                                           / cur.rounding) * cur.rounding
+            FROM account_analytic_account a, res_company c, res_currency cur,
+                 res_currency_rate_daily df, res_currency_rate_daily dt
+            WHERE a.id = l.account_id
+            AND c.id = l.company_id
+            AND cur.id = a.currency_id
+            AND c.currency_id != a.currency_id
+            AND df.currency_id = c.currency_id AND df.day = l.date
+            AND dt.currency_id = a.currency_id AND dt.day = l.date
+            AND df.rate != 0 AND dt.rate != 0
+            AND l.amount != 0
+            AND l.id IN %s
+            RETURNING l.id""", (ids,))
+        done_ids.update(row[0] for row in cr.fetchall())
+        remaining_ids = list(set(ids) - done_ids)
+        if remaining_ids:
+            self._store_set_values(cr, uid, remaining_ids,
+                                   ['aa_currency_id', 'aa_amount_currency'],
+                                   context=context)
+        self.invalidate_cache(cr, uid,
+                              ['aa_currency_id', 'aa_amount_currency'],
+                              list(ids), context=context)
+        self._clear_sums_cache(cr)
+
+    def _revalue_amount_currency(self, cr, uid, intervals, context=None):
+        """Recompute aa_amount_currency of the lines converted with a
+        currency whose daily rates changed, and record the totals of each
+        account before and after in account.analytic.revaluation.
+
+        :param intervals: list of (currency id, first day, last day) of
+                          the changed daily rates
+        :return: the ids of the revaluations, which are recorded as
+                 superuser since any user allowed to change the rates has
+                 to be able to revalue the lines
+        """
+        if not intervals:
+            return []
+        values = ', '.join(cr.mogrify('(%s, %s::date, %s::date)', interval)
+                           for interval in intervals)
+        where_revalued = """
+            a.id = l.account_id
+            AND c.id = l.company_id
+            AND c.currency_id != a.currency_id
+            AND l.amount != 0
+            AND EXISTS (SELECT 1
+                        FROM (VALUES """ + values + """)
+                            AS i(currency_id, date_from, date_to)
+                        WHERE i.currency_id IN (a.currency_id, c.currency_id)
+                        AND l.date BETWEEN i.date_from AND i.date_to)"""
+        cr.execute("""
+            WITH revalued AS (
+                UPDATE account_analytic_line l
+                SET aa_amount_currency = v.amount_currency
+                FROM (SELECT l.id, l.aa_amount_currency AS old_amount,
+                             round(l.amount * (dt.rate / df.rate)
+                                   / cur.rounding) * cur.rounding
+                                 AS amount_currency
+                      FROM account_analytic_line l,
+                           account_analytic_account a, res_company c,
+                           res_currency cur,
+                           res_currency_rate_daily df,
+                           res_currency_rate_daily dt
+                      WHERE """ + where_revalued + """
+                      AND cur.id = a.currency_id
+                      AND df.currency_id = c.currency_id AND df.day = l.date
+                      AND dt.currency_id = a.currency_id AND dt.day = l.date
+                      AND df.rate != 0 AND dt.rate != 0) AS v
+                WHERE l.id = v.id
+                AND l.aa_amount_currency IS DISTINCT FROM v.amount_currency
+                RETURNING l.account_id, l.date, v.old_amount,
+                          l.aa_amount_currency
+            )
+            SELECT account_id, min(date), count(*), sum(old_amount),
+                   sum(aa_amount_currency)
+            FROM revalued
+            GROUP BY account_id""")
+        totals = dict((row[0], list(row[1:])) for row in cr.fetchall())
+        # The lines without daily rate, e.g. dated before the first rate of
+        # a currency, are converted by res.currency.compute
+        cr.execute("""
+            SELECT l.id
+            FROM account_analytic_line l, account_analytic_account a,
+                 res_company c
+            WHERE """ + where_revalued + """
+            AND NOT EXISTS (SELECT 1 FROM res_currency_rate_daily df,
+                                          res_currency_rate_daily dt
+                            WHERE df.currency_id = c.currency_id
+                            AND df.day = l.date
+                            AND dt.currency_id = a.currency_id
+                            AND dt.day = l.date
+                            AND df.rate != 0 AND dt.rate != 0)""")
+        remaining_ids = [row[0] for row in cr.fetchall()]
+        if remaining_ids:
+            old_amounts = dict(
+                (line['id'], line['aa_amount_currency'])
+                for line in self.read(cr, uid, remaining_ids,
+                                      ['aa_amount_currency'],
+                                      context=context))
+            self._store_set_values(cr, uid, remaining_ids,
+                                   ['aa_amount_currency'], context=context)
+            self.invalidate_cache(cr, uid, ['aa_amount_currency'],
+                                  remaining_ids, context=context)
+            for line in self.browse(cr, uid, remaining_ids, context=context):
+                old_amount = old_amounts[line.id]
+                if line.aa_amount_currency == old_amount:
+                    continue
+                total = totals.setdefault(line.account_id.id,
+                                          [line.date, 0, 0.0, 0.0])
+                total[0] = min(total[0], line.date)
+                total[1] += 1
+                total[2] += old_amount
+                total[3] += line.aa_amount_currency
+        self.invalidate_cache(cr, uid, ['aa_amount_currency'],
+                              context=context)
+        self._clear_sums_cache(cr)
+        revaluation_obj = self.pool['account.analytic.revaluation']
+        revaluation_ids = []
+        for account_id, total in totals.iteritems():
+            date_from, line_count, amount_before, amount_after = total
+            revaluation_ids.append(revaluation_obj.create(cr, SUPERUSER_ID, {
+                'account_id': account_id,
+                'date_from': date_from,
+                'line_count': line_count,
+                'amount_before': amount_before,
+                'amount_after': amount_after,
+            }, context=context))
+        return revaluation_ids
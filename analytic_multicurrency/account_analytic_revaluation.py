@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Author: Joël Grand-Guillaume
+#    Copyright 2010-2013 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+from openerp.osv import orm, fields
+import openerp.addons.decimal_precision as dp
+
+
+class account_analytic_revaluation(orm.Model):
+    """Audit of the revaluations of the amounts in currency of the analytic
+    lines made when historical currency rates are corrected."""
+    _name = 'account.analytic.revaluation'
+    _description = 'Analytic Amounts in Currency Revaluation'
+    _order = 'date desc, id desc'
+
+    _columns = {
+        'date': fields.datetime('Date', required=True, readonly=True),
+        'account_id': fields.many2one('account.analytic.account',
+                                      'Analytic Account', required=True,
+                                      ondelete='cascade', select=True,
+                                      readonly=True),
+        'currency_id': fields.related('account_id', 'currency_id',
+                                      type='many2one',
+                                      relation='res.currency',
+                                      string='Currency', readonly=True),
+        'date_from': fields.date('Revalued From', readonly=True,
+                                 help="Date of the earliest revalued line."),
+        'line_count': fields.integer('Revalued Lines', readonly=True),
+        'amount_before': fields.float(
+            'Total Before', readonly=True,
+            digits_compute=dp.get_precision('Account')),
+        'amount_after': fields.float(
+            'Total After', readonly=True,
+            digits_compute=dp.get_precision('Account')),
+    }
+
+    _defaults = {
+        'date': fields.datetime.now,
+    }
@@ -19,64 +19,344 @@
 #
 ##############################################################################
 
-from itertools import product
+import time
+import weakref
+
 from openerp.osv import orm, fields
+from openerp.tools.lru import LRU
 import openerp.addons.decimal_precision as dp
 
+# Fields computed by account.analytic.account._get_analytic_sums
+SUM_FIELDS = ('debit', 'credit', 'balance', 'quantity', 'ca_invoiced',
+              'total_cost')
+
+# Maximum number of analytic sums cached per transaction
+SUMS_CACHE_SIZE = 64
+
+# cursor: (transaction id, LRU of the analytic sums)
+_sums_caches = weakref.WeakKeyDictionary()
+
 
 class account_analytic_account(orm.Model):
     _inherit = 'account.analytic.account'
 
-    def _debit_credit_bal_qtty(self, cr, uid, ids, field_list, arg,
-                               context=None):
-        """Replace the original amount column by aa_amount_currency"""
+    def _get_sums_cache(self, cr):
+        """Return the analytic sums cache of the current transaction of the
+        cursor, so the sums are not kept after a commit or a rollback"""
+        cr.execute("SELECT txid_current()")
+        txid = cr.fetchone()[0]
+        cache = _sums_caches.get(cr)
+        if cache is None or cache[0] != txid:
+            cache = _sums_caches[cr] = (txid, LRU(SUMS_CACHE_SIZE))
+        return cache[1]
+
+    def clear_sums_cache(self, cr):
+        _sums_caches.pop(cr, None)
+
+    def _get_period_clause(self, context):
+        """Return the SQL condition selecting the lines of the period given
+        by the from_date and to_date context keys, and its parameters"""
+        in_period = ['TRUE']
+        period_args = []
+        if context.get('from_date'):
+            in_period.append("l.date >= %s")
+            period_args.append(context['from_date'])
+        if context.get('to_date'):
+            in_period.append("l.date <= %s")
+            period_args.append(context['to_date'])
+        return ' AND '.join(in_period), period_args
+
+    def _get_sums_select(self, amount, in_period):
+        """Return the SQL expressions of the SUM_FIELDS of the lines summing
+        the amount expression, the condition in_period restricting the
+        debit, credit, balance and quantity"""
+        return """
+            COALESCE(SUM(
+                CASE WHEN """ + in_period + """ AND """ + amount + """ > 0
+                THEN """ + amount + """
+                ELSE 0.0
+                END), 0.0) AS debit,
+            COALESCE(SUM(
+                CASE WHEN """ + in_period + """ AND """ + amount + """ < 0
+                THEN -""" + amount + """
+                ELSE 0.0
+                END), 0.0) AS credit,
+            COALESCE(SUM(
+                CASE WHEN """ + in_period + """
+                THEN """ + amount + """
+                ELSE 0.0
+                END), 0.0) AS balance,
+            COALESCE(SUM(
+                CASE WHEN """ + in_period + """
+                THEN l.unit_amount
+                ELSE 0.0
+                END), 0.0) AS quantity,
+            COALESCE(SUM(
+                CASE WHEN j.type = 'sale'
+                THEN """ + amount + """
+                ELSE 0.0
+                END), 0.0) AS ca_invoiced,
+            COALESCE(SUM(
+                CASE WHEN l.amount < 0
+                THEN """ + amount + """
+                ELSE 0.0
+                END), 0.0) AS total_cost"""
+
+    def _get_line_sums(self, cr, uid, child_ids, context):
+        """Return the sums of the lines of the accounts of child_ids (not
+        including their children) per account and currency of the company
+        of the lines, computed in a single query.
+
+        :return: a dict {account id: {currency id: (values, source values)}}
+                 where values are the SUM_FIELDS summing the amounts in the
+                 currency of the account (aa_amount_currency) and source
+                 values the SUM_FIELDS summing the amounts in the currency
+                 of the company (amount)
+        """
+        cache = self._get_sums_cache(cr)
+        key = ('lines', uid, tuple(sorted(child_ids)),
+               context.get('from_date'), context.get('to_date'))
+        if key in cache:
+            return cache[key]
+        res = dict((account_id, {}) for account_id in child_ids)
+        if child_ids:
+            in_period, period_args = self._get_period_clause(context)
+            cr.execute("""
+                SELECT l.account_id, c.currency_id,
+                       """ + self._get_sums_select('l.aa_amount_currency',
+                                                   in_period) + """,
+                       """ + self._get_sums_select('l.amount',
+                                                   in_period) + """
+                FROM account_analytic_line l
+                JOIN account_analytic_journal j ON j.id = l.journal_id
+                LEFT JOIN res_company c ON c.id = l.company_id
+                WHERE l.account_id IN %s
+                GROUP BY l.account_id, c.currency_id""",
+                       period_args * 8 + [tuple(child_ids)])
+            size = len(SUM_FIELDS)
+            for row in cr.fetchall():
+                res[row[0]][row[1]] = (row[2:2 + size], row[2 + size:])
+        cache[key] = res
+        return res
+
+    def _get_analytic_sums(self, cr, uid, ids, context=None):
+        """Return the debit, credit, balance, quantity, invoiced amount and
+        total cost of the accounts, including their children, computed in
+        a single query on the lines and a single rollup of the tree.
+
+        The from_date and to_date context keys restrict the debit, credit,
+        balance and quantity. When the report_currency_id context key is
+        set, the sums are expressed in this currency (see
+        _get_report_sums). The result is cached in the transaction until
+        an analytic account or line is modified, so the fields read
+        separately (e.g. by the new API) share the same computation.
+        """
         if context is None:
             context = {}
+        cache = self._get_sums_cache(cr)
+        key = (uid, tuple(sorted(ids)), context.get('from_date'),
+               context.get('to_date'), context.get('report_currency_id'),
+               context.get('report_date'))
+        if key in cache:
+            return cache[key]
         child_ids = self.search(cr, uid,
                                 [('parent_id', 'child_of', ids)],
                                 context=context)
+        if context.get('report_currency_id'):
+            res = cache[key] = self._get_report_sums(cr, uid, ids, child_ids,
+                                                     context)
+            return res
+        precision = self.pool['decimal.precision'].precision_get(
+            cr, uid, 'Account')
         sums = {}
-        for child_id, field in product(child_ids, field_list):
-            sums.setdefault(child_id, {})[field] = 0.0
+        line_sums = self._get_line_sums(cr, uid, child_ids, context)
+        for account_id, subtotals in line_sums.iteritems():
+            values = sums[account_id] = dict.fromkeys(SUM_FIELDS, 0.0)
+            for subtotal, source_subtotal in subtotals.itervalues():
+                for field, value in zip(SUM_FIELDS, subtotal):
+                    values[field] += value
+            for field in ('ca_invoiced', 'total_cost'):
+                values[field] = round(values[field], precision)
+        res = self._compute_level_tree(cr, uid, ids, child_ids, sums,
+                                       list(SUM_FIELDS), context)
+        cache[key] = res
+        return res
 
-        where_date = ''
-        where_clause_args = [tuple(child_ids)]
-        if context.get('from_date'):
-            where_date += " AND l.date >= %s"
-            where_clause_args += [context['from_date']]
-        if context.get('to_date'):
-            where_date += " AND l.date <= %s"
-            where_clause_args += [context['to_date']]
+    def _get_currency_vectors(self, cr, uid, ids, child_ids, context):
+        """Return the sums of the accounts of ids, including their children,
+        per currency of the company of the lines, in this currency.
+
+        :return: a dict {account id: {currency id: SUM_FIELDS values}}
+        """
+        if not child_ids:
+            return {}
+        line_sums = self._get_line_sums(cr, uid, child_ids, context)
+        vectors = dict(
+            (account_id, dict((currency_id, list(source_subtotal))
+                              for currency_id, (subtotal, source_subtotal)
+                              in subtotals.iteritems()))
+            for account_id, subtotals in line_sums.iteritems())
+        parents, currencies, levels = self._get_tree_levels(cr, child_ids)
+        for level in reversed(levels[1:]):
+            for account_id in level:
+                parent_vector = vectors[parents[account_id]]
+                for currency_id, values in vectors[account_id].iteritems():
+                    subtotal = parent_vector.setdefault(
+                        currency_id, [0.0] * len(SUM_FIELDS))
+                    for index, value in enumerate(values):
+                        subtotal[index] += value
+        return dict((account_id, vectors[account_id]) for account_id in ids
+                    if account_id in vectors)
+
+    def get_currency_subtotals(self, cr, uid, ids, context=None):
+        """Return how much of the sums of the accounts, including their
+        children, comes from the lines of each currency.
+
+        The subtotals come from the query computing the balance fields and
+        share its cache. The from_date and to_date context keys restrict
+        the debit, credit, balance and quantity.
+
+        :return: a dict {account id: {currency id: {field: value}}}, the
+                 values of the SUM_FIELDS being expressed in the currency of
+                 the lines
+        """
+        if context is None:
+            context = {}
+        child_ids = self.search(cr, uid,
+                                [('parent_id', 'child_of', ids)],
+                                context=context)
+        vectors = self._get_currency_vectors(cr, uid, ids, child_ids,
+                                             context)
+        return dict(
+            (account_id, dict((currency_id, dict(zip(SUM_FIELDS, values)))
+                              for currency_id, values in vector.iteritems()))
+            for account_id, vector in vectors.iteritems())
+
+    def _get_tree_levels(self, cr, child_ids):
+        """Load the tree formed by the accounts of child_ids.
+
+        :return: a tuple (parents, currencies, levels) where parents maps
+                 each account to its parent, currencies maps each account
+                 to its currency and levels is the list of the accounts of
+                 each level, starting with the roots
+        """
         cr.execute("""
-              SELECT a.id,
-                     sum(
-                         CASE WHEN l.aa_amount_currency > 0
-                         THEN l.aa_amount_currency
-                         ELSE 0.0
-                         END
-                          ) as debit,
-                     sum(
-                         CASE WHEN l.aa_amount_currency < 0
-                         THEN -l.aa_amount_currency
-                         ELSE 0.0
-                         END
-                          ) as credit,
-                     COALESCE(SUM(l.aa_amount_currency),0) AS balance,
-                     COALESCE(SUM(l.unit_amount),0) AS quantity
-              FROM account_analytic_account a
-                  LEFT JOIN account_analytic_line l ON (a.id = l.account_id)
-              WHERE a.id IN %s
-              """ + where_date + """
-              GROUP BY a.id""", where_clause_args)
-        for ac_id, debit, credit, balance, quantity in cr.fetchall():
-            sums[ac_id] = {'debit': debit,
-                           'credit': credit,
-                           'balance': balance,
-                           'quantity': quantity}
-        return self._compute_level_tree(cr, uid, ids, child_ids, sums,
-                                        ['debit', 'credit',
-                                         'balance', 'quantity'],
-                                        context)
+            SELECT id, parent_id, currency_id
+            FROM account_analytic_account
+            WHERE id IN %s""", (tuple(child_ids),))
+        parents = {}
+        children = {}
+        currencies = {}
+        for account_id, parent_id, currency_id in cr.fetchall():
+            currencies[account_id] = currency_id
+            if parent_id:
+                parents[account_id] = parent_id
+                children.setdefault(parent_id, []).append(account_id)
+        levels = []
+        level = [account_id for account_id in currencies
+                 if parents.get(account_id) not in currencies]
+        while level:
+            levels.append(level)
+            level = [child_id for account_id in level
+                     for child_id in children.get(account_id, ())]
+        return parents, currencies, levels
+
+    def _get_report_sums(self, cr, uid, ids, child_ids, context):
+        """Return the sums of the accounts, including their children,
+        expressed in the reporting currency given by the report_currency_id
+        context key at the rate of the report_date context key (today by
+        default).
+
+        Only the subtotals of the accounts of ids per currency (see
+        _get_currency_vectors) are converted.
+        """
+        report_currency_id = context['report_currency_id']
+        date = context.get('report_date') or time.strftime('%Y-%m-%d')
+        vectors = self._get_currency_vectors(cr, uid, ids, child_ids,
+                                             context)
+        currency_obj = self.pool['res.currency']
+        rates = currency_obj.get_conversion_rates(
+            cr, uid, [(currency_id, report_currency_id, date)
+                      for vector in vectors.itervalues()
+                      for currency_id in vector
+                      if currency_id and currency_id != report_currency_id],
+            context=context)
+        report_currency = currency_obj.browse(cr, uid, report_currency_id,
+                                              context=context)
+        res = {}
+        for account_id, vector in vectors.iteritems():
+            values = res[account_id] = dict.fromkeys(SUM_FIELDS, 0.0)
+            for currency_id, subtotal in vector.iteritems():
+                # The currency is unknown for the lines without company
+                rate = 1.0
+                if currency_id and currency_id != report_currency_id:
+                    rate = rates[(currency_id, report_currency_id, date)]
+                for field, value in zip(SUM_FIELDS, subtotal):
+                    if field != 'quantity':
+                        value = currency_obj.round(cr, uid, report_currency,
+                                                   value * rate)
+                    values[field] += value
+        return res
+
+    def _compute_level_tree(self, cr, uid, ids, child_ids, res, field_names,
+                            context=None):
+        """Roll up the values of field_names of the accounts of child_ids
+        from the leaves to the accounts of ids, level by level.
+
+        The totals of the children of each level are summed per parent and
+        currency, and converted to the currency of the parent once per
+        distinct pair of currencies, with the rates cache of res.currency.
+        """
+        if context is None:
+            context = {}
+        if not child_ids:
+            return {}
+        parents, currencies, levels = self._get_tree_levels(cr, child_ids)
+        totals = dict((account_id, dict(res[account_id]))
+                      for account_id in currencies)
+        currency_obj = self.pool['res.currency']
+        date = context.get('date') or time.strftime('%Y-%m-%d')
+        for level in reversed(levels[1:]):
+            subtotals = {}
+            for account_id in level:
+                key = (parents[account_id], currencies[account_id])
+                subtotal = subtotals.setdefault(
+                    key, dict.fromkeys(field_names, 0.0))
+                for field in field_names:
+                    subtotal[field] += totals[account_id][field]
+            pairs = set((from_id, currencies[parent_id])
+                        for parent_id, from_id in subtotals)
+            pairs = [(from_id, to_id) for from_id, to_id in pairs
+                     if from_id and to_id and from_id != to_id]
+            rates = currency_obj.get_conversion_rates(
+                cr, uid, [(from_id, to_id, date) for from_id, to_id in pairs],
+                context=context)
+            to_currencies = dict(
+                (currency.id, currency) for currency in currency_obj.browse(
+                    cr, uid, list(set(to_id for from_id, to_id in pairs)),
+                    context=context))
+            for (parent_id, from_id), subtotal in subtotals.iteritems():
+                to_id = currencies[parent_id]
+                convert = from_id and to_id and from_id != to_id
+                for field in field_names:
+                    amount = subtotal[field]
+                    if convert and field != 'quantity':
+                        amount = currency_obj.round(
+                            cr, uid, to_currencies[to_id],
+                            amount * rates[(from_id, to_id, date)])
+                    totals[parent_id][field] += amount
+        return dict((account_id, totals[account_id]) for account_id in ids
+                    if account_id in totals)
+
+    def _debit_credit_bal_qtty(self, cr, uid, ids, field_list, arg,
+                               context=None):
+        """Replace the original amount column by aa_amount_currency"""
+        if isinstance(field_list, basestring):
+            field_list = [field_list]
+        sums = self._get_analytic_sums(cr, uid, ids, context=context)
+        return dict((account_id, dict((field, values[field])
+                                      for field in field_list))
+                    for account_id, values in sums.iteritems())
 
     def _set_company_currency(self, cr, uid, ids, name, value, arg,
                               context=None):
@@ -132,6 +412,14 @@ class account_analytic_account(orm.Model):
                                     type='float',
                                     string='Quantity',
                                     multi='debit_credit_bal_qtty'),
+        'currency_amounts_stale': fields.boolean(
+            'Amounts in Currency Outdated', readonly=True,
+            help="Set while the amounts in currency of the analytic lines "
+                 "are recomputed in background after a change of the "
+                 "currency or of the company of the account."),
+        'currency_job_ids': fields.one2many(
+            'account.analytic.currency.job', 'account_id',
+            'Recomputations of the Amounts in Currency', readonly=True),
         # We overwrite function field currency_id to set a currency different
         # from the one specified in the company
         'currency_id': fields.function(
@@ -145,6 +433,61 @@ class account_analytic_account(orm.Model):
             relation='res.currency'),
     }
 
+    def _get_currency_recompute_limit(self, cr, uid, context=None):
+        """Number of lines above which the amounts in currency of an
+        account are recomputed in background"""
+        param_obj = self.pool['ir.config_parameter']
+        return int(param_obj.get_param(
+            cr, uid, 'analytic_multicurrency.currency_recompute_limit',
+            default=1000, context=context))
+
+    def _recompute_amount_currency(self, cr, uid, ids, context=None):
+        """Recompute the amounts in currency of the lines of the accounts,
+        at once for the accounts having few lines and by a background job
+        for the others"""
+        line_obj = self.pool['account.analytic.line']
+        job_obj = self.pool['account.analytic.currency.job']
+        limit = self._get_currency_recompute_limit(cr, uid, context=context)
+        deferred_ids = []
+        for account_id in ids:
+            cr.execute("""
+                SELECT id FROM account_analytic_line
+                WHERE account_id = %s LIMIT %s""", (account_id, limit + 1))
+            line_ids = [row[0] for row in cr.fetchall()]
+            if len(line_ids) > limit:
+                deferred_ids.append(account_id)
+            else:
+                line_obj._compute_amount_currency_sql(cr, uid, line_ids,
+                                                      context=context)
+        if deferred_ids:
+            job_obj.enqueue(cr, uid, deferred_ids, context=context)
+
+    def create(self, cr, uid, vals, context=None):
+        self.clear_sums_cache(cr)
+        return super(account_analytic_account, self).create(
+            cr, uid, vals, context=context)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        self.clear_sums_cache(cr)
+        res = super(account_analytic_account, self).write(
+            cr, uid, ids, vals, context=context)
+        if 'currency_id' in vals or 'company_id' in vals:
+            if isinstance(ids, (int, long)):
+                ids = [ids]
+            self._recompute_amount_currency(cr, uid, ids, context=context)
+        return res
+
+    def unlink(self, cr, uid, ids, context=None):
+        self.clear_sums_cache(cr)
+        return super(account_analytic_account, self).unlink(
+            cr, uid, ids, context=context)
+
+    def _store_set_values(self, cr, uid, ids, fields, context=None):
+        res = super(account_analytic_account, self)._store_set_values(
+            cr, uid, ids, fields, context=context)
+        self.clear_sums_cache(cr)
+        return res
+
     # We remove the currency constraint cause we want to let the user
     # choose another currency than the company one. Don't be able to
     # override properly this constraints :(
@@ -19,7 +19,6 @@
 #
 ##############################################################################
 
-from itertools import product
 from openerp.osv import orm, fields
 import openerp.addons.decimal_precision as dp
 
@@ -27,76 +26,29 @@ import openerp.addons.decimal_precision as dp
 class account_analytic_account(orm.Model):
     _inherit = "account.analytic.account"
 
-    def _ca_invoiced_calc(self, cr, uid, ids, name, arg, context=None):
-        """Replace the original amount column by aa_amount_currency"""
-        child_ids = self.search(cr, uid,
-                                [('parent_id', 'child_of', ids)],
-                                context=context)
-        sums = {}
-        for child_id, field in product(child_ids, name):
-            sums.setdefault(child_id, {})[name] = 0.0
+    def _analysis_sums(self, cr, uid, ids, field_names, arg, context=None):
+        """Replace the original amount column by aa_amount_currency.
 
-        sql = ("SELECT account_analytic_line.account_id, "
-               "       COALESCE(SUM(aa_amount_currency), 0.0) "
-               "FROM account_analytic_line "
-               "JOIN account_analytic_journal "
-               "ON account_analytic_line.journal_id = "
-               "account_analytic_journal.id "
-               "WHERE account_analytic_line.account_id IN %s "
-               "AND account_analytic_journal.type = 'sale' "
-               "GROUP BY account_analytic_line.account_id")
-        cr.execute(sql, (tuple(child_ids),))
-
-        precision_obj = self.pool.get('decimal.precision')
-        precision = precision_obj.precision_get(cr, uid, 'Account')
-        for account_id, row_sum in cr.fetchall():
-            sums[account_id][name] = round(row_sum, precision)
-        data = self._compute_level_tree(cr, uid, ids, child_ids,
-                                        sums, [name], context=context)
-        return dict((account_id, row[name]) for account_id, row
-                    in data.iteritems())
-
-    def _total_cost_calc(self, cr, uid, ids, name, arg, context=None):
-        """Replace the original amount column by aa_amount_currency"""
-        child_ids = self.search(cr, uid,
-                                [('parent_id', 'child_of', ids)],
-                                context=context)
-        sums = {}
-        for child_id, field in product(child_ids, name):
-            sums.setdefault(child_id, {})[name] = 0.0
-
-        sql = ("SELECT account_analytic_line.account_id, "
-               "       COALESCE(SUM(aa_amount_currency), 0.0) "
-               "FROM account_analytic_line "
-               "JOIN account_analytic_journal "
-               "ON account_analytic_line.journal_id "
-               " = account_analytic_journal.id "
-               "WHERE account_analytic_line.account_id IN %s "
-               "AND amount < 0 "
-               "GROUP BY account_analytic_line.account_id")
-        cr.execute(sql, (tuple(child_ids),))
-
-        precision_obj = self.pool.get('decimal.precision')
-        precision = precision_obj.precision_get(cr, uid, 'Account')
-        for account_id, row_sum in cr.fetchall():
-            sums[account_id][name] = round(row_sum, precision)
-        data = self._compute_level_tree(cr, uid, ids, child_ids,
-                                        sums, [name], context)
-        return dict((account_id, row[name]) for account_id, row
-                    in data.iteritems())
+        The invoiced amount and the total cost are computed together with
+        the debit, credit, balance and quantity, in the same pass.
+        """
+        return self._debit_credit_bal_qtty(cr, uid, ids, field_names, arg,
+                                           context=context)
 
     _columns = {
         'ca_invoiced': fields.function(
-            _ca_invoiced_calc,
+            _analysis_sums,
             type='float',
             string='Invoiced Amount',
+            multi='debit_credit_bal_qtty',
             help="Total customer invoiced amount for "
                  "this account.",
             digits_compute=dp.get_precision('Account')),
         'total_cost': fields.function(
-            _total_cost_calc,
+            _analysis_sums,
             type='float',
             string='Total Costs',
+            multi='debit_credit_bal_qtty',
             help="Total of costs for this account. "
                  "It includes real costs (from "
                  "invoices) and indirect costs, "
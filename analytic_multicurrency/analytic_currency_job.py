@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Author: Joël Grand-Guillaume
+#    Copyright 2010-2013 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+
+import logging
+import threading
+
+from openerp import SUPERUSER_ID
+from openerp.osv import orm, fields
+
+_logger = logging.getLogger(__name__)
+
+
+class account_analytic_currency_job(orm.Model):
+    """Background recomputation of the amounts in currency of the lines of
+    an analytic account whose currency or company changed."""
+    _name = 'account.analytic.currency.job'
+    _description = 'Analytic Amounts in Currency Recomputation'
+    _order = 'id'
+
+    def _progress(self, cr, uid, ids, field_name, arg, context=None):
+        result = {}
+        for job in self.browse(cr, uid, ids, context=context):
+            if job.state == 'done' or not job.line_count:
+                result[job.id] = 100.0
+            else:
+                result[job.id] = 100.0 * job.done_count / job.line_count
+        return result
+
+    _columns = {
+        'account_id': fields.many2one('account.analytic.account',
+                                      'Analytic Account', required=True,
+                                      ondelete='cascade', select=True),
+        'state': fields.selection([('pending', 'Pending'),
+                                   ('done', 'Done')],
+                                  'Status', required=True, readonly=True),
+        'line_count': fields.integer('Lines to Recompute', readonly=True),
+        'done_count': fields.integer('Recomputed Lines', readonly=True),
+        'last_line_id': fields.integer('Last Recomputed Line',
+                                       readonly=True),
+        'progress': fields.function(_progress, type='float',
+                                    string='Progress (%)'),
+    }
+
+    _defaults = {
+        'state': 'pending',
+    }
+
+    def enqueue(self, cr, uid, account_ids, context=None):
+        """Schedule the recomputation of all the lines of the accounts,
+        restarting their pending jobs, and flag their amounts in currency
+        as stale until it is done.
+
+        The jobs are managed as superuser since any user allowed to change
+        the currency of an account has to be able to schedule them."""
+        for account_id in account_ids:
+            cr.execute("SELECT count(*) FROM account_analytic_line "
+                       "WHERE account_id = %s", (account_id,))
+            vals = {'line_count': cr.fetchone()[0],
+                    'done_count': 0,
+                    'last_line_id': 0}
+            job_ids = self.search(cr, SUPERUSER_ID,
+                                  [('account_id', '=', account_id),
+                                   ('state', '=', 'pending')],
+                                  context=context)
+            if job_ids:
+                self.write(cr, SUPERUSER_ID, job_ids, vals, context=context)
+            else:
+                vals['account_id'] = account_id
+                self.create(cr, SUPERUSER_ID, vals, context=context)
+        self.pool['account.analytic.account'].write(
+            cr, SUPERUSER_ID, account_ids, {'currency_amounts_stale': True},
+            context=context)
+
+    def run(self, cr, uid, chunk_size=5000, context=None):
+        """Process the pending jobs by chunks of lines, committing after
+        each chunk so that the progress is visible and kept if the
+        process is interrupted."""
+        line_obj = self.pool['account.analytic.line']
+        testing = getattr(threading.currentThread(), 'testing', False)
+        job_ids = self.search(cr, uid, [('state', '=', 'pending')],
+                              context=context)
+        for job in self.browse(cr, uid, job_ids, context=context):
+            last_line_id = job.last_line_id
+            done_count = job.done_count
+            while True:
+                cr.execute("""
+                    SELECT id FROM account_analytic_line
+                    WHERE account_id = %s AND id > %s
+                    ORDER BY id LIMIT %s""",
+                           (job.account_id.id, last_line_id, chunk_size))
+                line_ids = [row[0] for row in cr.fetchall()]
+                if not line_ids:
+                    break
+                line_obj._compute_amount_currency_sql(cr, uid, line_ids,
+                                                      context=context)
+                last_line_id = line_ids[-1]
+                done_count += len(line_ids)
+                self.write(cr, uid, [job.id],
+                           {'last_line_id': last_line_id,
+                            'done_count': done_count},
+                           context=context)
+                if not testing:
+                    cr.commit()
+                _logger.info("Analytic account %s: %d/%d amounts in "
+                             "currency recomputed", job.account_id.id,
+                             done_count, job.line_count)
+            self.write(cr, uid, [job.id], {'state': 'done'}, context=context)
+            self.pool['account.analytic.account'].write(
+                cr, uid, [job.account_id.id],
+                {'currency_amounts_stale': False}, context=context)
+            if not testing:
+                cr.commit()
+        return True
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Author: Joël Grand-Guillaume
+#    Copyright 2010-2013 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+
+import weakref
+
+from openerp.osv import orm
+from openerp.tools.lru import LRU
+
+# Maximum number of (from currency, to currency, date) rates cached per
+# transaction
+RATE_CACHE_SIZE = 4096
+
+# Context keys read by the rate computation besides date, e.g. by the
+# override of _get_current_rate in account_voucher
+RATE_CONTEXT_KEYS = ('voucher_special_currency',
+                     'voucher_special_currency_rate')
+
+# cursor: (transaction id, LRU of the conversion rates)
+_rate_caches = weakref.WeakKeyDictionary()
+
+
+class res_currency(orm.Model):
+    _inherit = 'res.currency'
+
+    def _get_rate_cache(self, cr):
+        """Return the conversion rates cache of the current transaction of
+        the cursor, so the rates are not kept after a commit or a
+        rollback."""
+        cr.execute("SELECT txid_current()")
+        txid = cr.fetchone()[0]
+        cache = _rate_caches.get(cr)
+        if cache is None or cache[0] != txid:
+            cache = _rate_caches[cr] = (txid, LRU(RATE_CACHE_SIZE))
+        return cache[1]
+
+    def clear_rate_cache(self, cr):
+        _rate_caches.pop(cr, None)
+
+    def get_conversion_rates(self, cr, uid, keys, context=None):
+        """Return a dict mapping each (from currency id, to currency id,
+        date) of keys to its conversion rate.
+
+        Each rate is looked up only once and kept in a cache bounded to
+        RATE_CACHE_SIZE entries shared by all the calls made in the same
+        transaction with the same RATE_CONTEXT_KEYS.
+        """
+        if context is None:
+            context = {}
+        cache = self._get_rate_cache(cr)
+        context_key = tuple(context.get(name) for name in RATE_CONTEXT_KEYS)
+        rates = {}
+        for key in set(keys):
+            cache_key = key + context_key
+            if cache_key in cache:
+                rates[key] = cache[cache_key]
+                continue
+            from_id, to_id, date = key
+            ctx = dict(context, date=date)
+            from_currency = self.browse(cr, uid, from_id, context=ctx)
+            to_currency = self.browse(cr, uid, to_id, context=ctx)
+            rates[key] = cache[cache_key] = self._get_conversion_rate(
+                cr, uid, from_currency, to_currency, context=ctx)
+        return rates
+
+    def compute_batch(self, cr, uid, items, round=True, context=None):
+        """Convert many amounts at once.
+
+        :param items: list of (from currency id, to currency id, date,
+                      amount) tuples
+        :return: the list of the converted amounts, identical to the
+                 results of ``compute`` for each item
+        """
+        rates = self.get_conversion_rates(
+            cr, uid,
+            [item[:3] for item in items if item[0] != item[1]],
+            context=context)
+        currencies = dict(
+            (currency.id, currency) for currency in self.browse(
+                cr, uid, list(set(item[1] for item in items)),
+                context=context))
+        res = []
+        for from_id, to_id, date, amount in items:
+            if from_id != to_id:
+                amount *= rates[(from_id, to_id, date)]
+            if round:
+                amount = self.round(cr, uid, currencies[to_id], amount)
+            res.append(amount)
+        return res
+
+
+class res_currency_rate(orm.Model):
+    _inherit = 'res.currency.rate'
+
+    def _refresh_daily_rates(self, cr, uid, rates, context=None):
+        """Refresh the daily rates from the day of the earliest of the
+        (currency id, date) of rates, and revalue the analytic lines
+        converted with the daily rates which changed."""
+        daily_obj = self.pool['res.currency.rate.daily']
+        date_from = {}
+        for currency_id, name in rates:
+            day = name[:10]
+            if currency_id not in date_from or day < date_from[currency_id]:
+                date_from[currency_id] = day
+        intervals = []
+        for currency_id, day in date_from.iteritems():
+            intervals += daily_obj.refresh(cr, currency_ids=[currency_id],
+                                           date_from=day)
+        self.pool['account.analytic.line']._revalue_amount_currency(
+            cr, uid, intervals, context=context)
+
+    def _get_rate_keys(self, cr, uid, ids, context=None):
+        return [(rate.currency_id.id, rate.name)
+                for rate in self.browse(cr, uid, ids, context=context)]
+
+    def create(self, cr, uid, vals, context=None):
+        self.pool['res.currency'].clear_rate_cache(cr)
+        rate_id = super(res_currency_rate, self).create(
+            cr, uid, vals, context=context)
+        self._refresh_daily_rates(
+            cr, uid, self._get_rate_keys(cr, uid, [rate_id], context=context),
+            context=context)
+        return rate_id
+
+    def write(self, cr, uid, ids, vals, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        self.pool['res.currency'].clear_rate_cache(cr)
+        keys = self._get_rate_keys(cr, uid, ids, context=context)
+        res = super(res_currency_rate, self).write(
+            cr, uid, ids, vals, context=context)
+        keys += self._get_rate_keys(cr, uid, ids, context=context)
+        self._refresh_daily_rates(cr, uid, keys, context=context)
+        return res
+
+    def unlink(self, cr, uid, ids, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        self.pool['res.currency'].clear_rate_cache(cr)
+        keys = self._get_rate_keys(cr, uid, ids, context=context)
+        res = super(res_currency_rate, self).unlink(
+            cr, uid, ids, context=context)
+        self._refresh_daily_rates(cr, uid, keys, context=context)
+        return res
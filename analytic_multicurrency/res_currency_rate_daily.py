@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Author: Joël Grand-Guillaume
+#    Copyright 2010-2013 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+
+import time
+
+from openerp.osv import orm, fields
+
+
+class res_currency_rate_daily(orm.Model):
+    """Gap-filled table of the rate of each currency for each day.
+
+    The rate of a day is the rate of the last ``res.currency.rate`` dated
+    on or before this day, i.e. the rate ``res.currency.compute`` uses for
+    this date. It allows converting amounts in SQL, with a simple join on
+    (currency, day).
+    """
+    _name = 'res.currency.rate.daily'
+    _description = 'Daily Currency Rate'
+    _log_access = False
+    _order = 'currency_id, day'
+
+    _columns = {
+        'currency_id': fields.many2one('res.currency', 'Currency',
+                                       required=True, ondelete='cascade'),
+        'day': fields.date('Day', required=True),
+        'rate': fields.float('Rate', digits=(12, 6), required=True),
+    }
+
+    _sql_constraints = [
+        ('currency_day_uniq', 'unique(currency_id, day)',
+         'There is only one daily rate per currency and day.'),
+    ]
+
+    def init(self, cr):
+        cr.execute("SELECT 1 FROM res_currency_rate_daily LIMIT 1")
+        if not cr.fetchone():
+            self.refresh(cr)
+
+    def refresh(self, cr, currency_ids=None, date_from=None):
+        """Rebuild the daily rates of the currencies (all of them by
+        default) from date_from (their first rate by default) up to today,
+        or the last day having a rate if it is later.
+
+        Only the daily rates which differ are written.
+
+        :return: the list of (currency id, first day, last day) intervals
+                 including all the days whose rate changed
+        """
+        where = []
+        currency_params = []
+        if currency_ids:
+            where.append('currency_id IN %s')
+            currency_params.append(tuple(currency_ids))
+        where_currency = where and 'WHERE ' + where[0] or ''
+        date_params = []
+        if date_from:
+            where.append('day >= %s')
+            date_params.append(date_from)
+        where_old = where and 'WHERE ' + ' AND '.join(where) or ''
+        today = time.strftime('%Y-%m-%d')
+        cr.execute("""
+            WITH new AS (
+                SELECT currency_id, day, rate FROM (
+                    SELECT days.currency_id, days.day::date AS day,
+                           (SELECT r.rate FROM res_currency_rate r
+                            WHERE r.currency_id = days.currency_id
+                            AND r.name <= days.day
+                            ORDER BY r.name DESC LIMIT 1) AS rate
+                    FROM (
+                        SELECT currency_id,
+                               generate_series(
+                                   GREATEST(date_trunc('day', first_name),
+                                            %s::timestamp),
+                                   GREATEST(date_trunc('day', last_name)
+                                            + interval '1 day',
+                                            %s::timestamp),
+                                   interval '1 day') AS day
+                        FROM (SELECT currency_id, min(name) AS first_name,
+                                     max(name) AS last_name
+                              FROM res_currency_rate
+                              """ + where_currency + """
+                              GROUP BY currency_id) AS bounds
+                    ) AS days
+                ) AS rates
+                WHERE rate IS NOT NULL
+            ), old AS (
+                SELECT currency_id, day, rate
+                FROM res_currency_rate_daily
+                """ + where_old + """
+            ), updated AS (
+                UPDATE res_currency_rate_daily d
+                SET rate = new.rate
+                FROM new
+                WHERE d.currency_id = new.currency_id
+                AND d.day = new.day
+                AND d.rate != new.rate
+                RETURNING d.currency_id, d.day
+            ), inserted AS (
+                INSERT INTO res_currency_rate_daily (currency_id, day, rate)
+                SELECT new.currency_id, new.day, new.rate
+                FROM new
+                LEFT JOIN old ON old.currency_id = new.currency_id
+                              AND old.day = new.day
+                WHERE old.day IS NULL
+                RETURNING currency_id, day
+            ), deleted AS (
+                DELETE FROM res_currency_rate_daily d
+                USING old LEFT JOIN new ON new.currency_id = old.currency_id
+                                        AND new.day = old.day
+                WHERE d.currency_id = old.currency_id
+                AND d.day = old.day
+                AND new.day IS NULL
+                RETURNING d.currency_id, d.day
+            )
+            SELECT currency_id, min(day), max(day)
+            FROM (SELECT currency_id, day FROM updated
+                  UNION ALL SELECT currency_id, day FROM inserted
+                  UNION ALL SELECT currency_id, day FROM deleted) AS changed
+            GROUP BY currency_id""",
+                   [date_from or '1900-01-01', today] + currency_params +
+                   currency_params + date_params)
+        return cr.fetchall()
+
+    def extend(self, cr, date):
+        """Make sure the daily rates cover every day until date, by
+        repeating the last rate of each currency."""
+        conflict = ''
+        if cr._cnx.server_version >= 90500:
+            conflict = 'ON CONFLICT (currency_id, day) DO NOTHING'
+        else:
+            # Without ON CONFLICT, the transactions extending the rates are
+            # serialized, so the insert of the second one sees the days
+            # inserted by the first one
+            cr.execute("SELECT pg_advisory_xact_lock("
+                       "hashtext('res_currency_rate_daily-extend'))")
+        cr.execute("""
+            INSERT INTO res_currency_rate_daily (currency_id, day, rate)
+            SELECT last.currency_id, days.day::date, last.rate
+            FROM (SELECT DISTINCT ON (currency_id) currency_id, day, rate
+                  FROM res_currency_rate_daily
+                  ORDER BY currency_id, day DESC) AS last,
+                 generate_series(
+                     (SELECT min(day) FROM (
+                          SELECT max(day) AS day
+                          FROM res_currency_rate_daily
+                          GROUP BY currency_id) AS last_days)
+                     + interval '1 day',
+                     %s::timestamp, interval '1 day') AS days(day)
+            WHERE days.day > last.day
+            """ + conflict, (date,))
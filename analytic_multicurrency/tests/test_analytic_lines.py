@@ -422,3 +422,353 @@ class TestAnalyticLine(common.TransactionCase):
     def test_account_change_currency(self):
         self.agrolait.write({'currency_id': False})
         self.assertEqual(self.currency_eur_id.id, self.agrolait.currency_id.id)
+
+    def test_compute_batch(self):
+        self.res_currency_rate_model.create({
+            'name': fields.Date.today() + ' 00:00:00',
+            'currency_id': self.currency_usd_id.id,
+            'rate': 0.75,
+        })
+        currency_model = self.env['res.currency']
+        today = fields.Date.today()
+        items = [
+            (self.currency_eur_id.id, self.currency_usd_id.id, today, 100),
+            (self.currency_eur_id.id, self.currency_usd_id.id, today, 33.33),
+            (self.currency_usd_id.id, self.currency_eur_id.id, today, 10),
+            (self.currency_eur_id.id, self.currency_eur_id.id, today, 1.005),
+        ]
+        amounts = currency_model.compute_batch(items)
+        for (from_id, to_id, date, amount), converted in zip(items, amounts):
+            from_currency = currency_model.with_context(date=date).browse(
+                from_id)
+            expected = from_currency.compute(amount,
+                                             currency_model.browse(to_id))
+            self.assertAlmostEqual(expected, converted)
+
+    def test_daily_rates(self):
+        self.res_currency_rate_model.create({
+            'name': '2015-01-10 00:00:00',
+            'currency_id': self.currency_usd_id.id,
+            'rate': 2.0,
+        })
+        rate = self.res_currency_rate_model.create({
+            'name': '2015-01-20 12:00:00',
+            'currency_id': self.currency_usd_id.id,
+            'rate': 4.0,
+        })
+        daily_model = self.env['res.currency.rate.daily']
+
+        def daily_rate(day):
+            return daily_model.search([
+                ('currency_id', '=', self.currency_usd_id.id),
+                ('day', '=', day)]).rate
+
+        self.assertAlmostEqual(2.0, daily_rate('2015-01-15'))
+        self.assertAlmostEqual(2.0, daily_rate('2015-01-20'))
+        self.assertAlmostEqual(4.0, daily_rate('2015-01-21'))
+        rate.write({'rate': 3.0})
+        self.assertAlmostEqual(3.0, daily_rate('2015-01-21'))
+        rate.unlink()
+        self.assertAlmostEqual(2.0, daily_rate('2015-01-21'))
+        self.registry('res.currency.rate.daily').refresh(
+            self.cr, date_from='2015-01-15')
+        self.assertAlmostEqual(2.0, daily_rate('2015-01-21'))
+
+    def test_amount_currency_sql(self):
+        self.res_currency_rate_model.create({
+            'name': fields.Date.today() + ' 00:00:00',
+            'currency_id': self.currency_usd_id.id,
+            'rate': 0.75,
+        })
+        self.agrolait.write(
+            {'currency_id': self.currency_usd_id.id}
+        )
+        aal_rs = self.account_analytic_line_obj.browse()
+        for amount in (100, 33.33, -0.01):
+            aal_rs |= self.account_analytic_line_obj.create({
+                'account_id': self.agrolait.id,
+                'name': 'AGROLAIT',
+                'journal_id': self.aajournal.id,
+                'date': fields.Date.today(),
+                'amount': amount,
+                'general_account_id': self.account_rcv_id.id,
+            })
+        expected = aal_rs.mapped('aa_amount_currency')
+        self.env.cr.execute(
+            "UPDATE account_analytic_line SET aa_amount_currency = 0 "
+            "WHERE id IN %s", (tuple(aal_rs.ids),))
+        aal_rs._compute_amount_currency_sql()
+        self.assertEqual(expected, aal_rs.mapped('aa_amount_currency'))
+
+    def test_currency_change_background_recompute(self):
+        self.res_currency_rate_model.create({
+            'name': fields.Date.today() + ' 00:00:00',
+            'currency_id': self.currency_usd_id.id,
+            'rate': 0.50,
+        })
+        aal_rs = self.account_analytic_line_obj.create({
+            'account_id': self.agrolait.id,
+            'name': 'AGROLAIT',
+            'journal_id': self.aajournal.id,
+            'date': fields.Date.today(),
+            'amount': 100,
+            'general_account_id': self.account_rcv_id.id,
+        })
+        self.env['ir.config_parameter'].set_param(
+            'analytic_multicurrency.currency_recompute_limit', '0')
+        self.agrolait.write(
+            {'currency_id': self.currency_usd_id.id}
+        )
+        self.assertTrue(self.agrolait.currency_amounts_stale)
+        job = self.agrolait.currency_job_ids
+        self.assertEqual('pending', job.state)
+        self.env['account.analytic.currency.job'].run(chunk_size=1)
+        self.agrolait.refresh()
+        self.assertFalse(self.agrolait.currency_amounts_stale)
+        self.assertEqual('done', job.state)
+        self.assertEqual(job.line_count, job.done_count)
+        self.assertAlmostEqual(100.0, job.progress)
+        self.assertEqual('USD', aal_rs.aa_currency_id.name)
+        self.assertAlmostEqual(50, aal_rs.aa_amount_currency)
+
+    def test_revaluation(self):
+        rate = self.res_currency_rate_model.create({
+            'name': '2015-03-01 00:00:00',
+            'currency_id': self.currency_usd_id.id,
+            'rate': 0.50,
+        })
+        self.agrolait.write(
+            {'currency_id': self.currency_usd_id.id}
+        )
+        aal_rs = self.account_analytic_line_obj.browse()
+        for date in ('2015-03-10', '2015-04-10'):
+            aal_rs |= self.account_analytic_line_obj.create({
+                'account_id': self.agrolait.id,
+                'name': 'AGROLAIT',
+                'journal_id': self.aajournal.id,
+                'date': date,
+                'amount': 100,
+                'general_account_id': self.account_rcv_id.id,
+            })
+        self.res_currency_rate_model.create({
+            'name': '2015-04-01 00:00:00',
+            'currency_id': self.currency_usd_id.id,
+            'rate': 0.50,
+        })
+        revaluation_model = self.env['account.analytic.revaluation']
+        domain = [('account_id', '=', self.agrolait.id)]
+        # Same rate, nothing to revalue
+        self.assertFalse(revaluation_model.search(domain))
+        rate.write({'rate': 0.25})
+        self.assertEqual([25, 50], aal_rs.mapped('aa_amount_currency'))
+        revaluation = revaluation_model.search(domain)
+        self.assertEqual(1, revaluation.line_count)
+        self.assertEqual('2015-03-10', revaluation.date_from)
+        self.assertAlmostEqual(50, revaluation.amount_before)
+        self.assertAlmostEqual(25, revaluation.amount_after)
+
+    def test_analytic_sums(self):
+        account = self.account_analytic_account_obj.create({
+            'name': 'Sums',
+            'parent_id': self.agrolait.id,
+        })
+        for amount in (100, -30):
+            self.account_analytic_line_obj.create({
+                'account_id': account.id,
+                'name': 'SUMS',
+                'journal_id': self.aajournal.id,
+                'date': fields.Date.today(),
+                'amount': amount,
+                'unit_amount': 1,
+                'general_account_id': self.account_rcv_id.id,
+            })
+        values = account.read(['debit', 'credit', 'balance', 'quantity',
+                               'ca_invoiced', 'total_cost'])[0]
+        self.assertAlmostEqual(100, values['debit'])
+        self.assertAlmostEqual(30, values['credit'])
+        self.assertAlmostEqual(70, values['balance'])
+        self.assertAlmostEqual(2, values['quantity'])
+        self.assertAlmostEqual(70, values['ca_invoiced'])
+        self.assertAlmostEqual(-30, values['total_cost'])
+        balance = self.agrolait.balance
+        self.account_analytic_line_obj.create({
+            'account_id': account.id,
+            'name': 'SUMS',
+            'journal_id': self.aajournal.id,
+            'date': fields.Date.today(),
+            'amount': 5,
+            'general_account_id': self.account_rcv_id.id,
+        })
+        self.agrolait.invalidate_cache()
+        self.assertAlmostEqual(balance + 5, self.agrolait.balance)
+        self.assertAlmostEqual(
+            75, account.with_context(to_date='2000-01-01').ca_invoiced)
+        self.assertAlmostEqual(
+            0, account.with_context(to_date='2000-01-01').balance)
+
+    def test_analytic_sums_sql_writes(self):
+        account = self.account_analytic_account_obj.create({
+            'name': 'Sums',
+            'currency_id': self.currency_usd_id.id,
+        })
+        line = self.account_analytic_line_obj.create({
+            'account_id': account.id,
+            'name': 'SUMS',
+            'journal_id': self.aajournal.id,
+            'date': fields.Date.today(),
+            'amount': 100,
+            'general_account_id': self.account_rcv_id.id,
+        })
+        balance = account.balance
+        self.env.cr.execute(
+            "UPDATE account_analytic_line SET amount = 200 WHERE id = %s",
+            (line.id,))
+        self.account_analytic_line_obj._compute_amount_currency_sql(
+            line.ids)
+        account.invalidate_cache()
+        self.assertAlmostEqual(balance * 2, account.balance)
+
+    def test_level_tree_currencies(self):
+        self.res_currency_rate_model.create({
+            'name': fields.Date.today() + ' 00:00:00',
+            'currency_id': self.currency_usd_id.id,
+            'rate': 0.50,
+        })
+        parent = self.account_analytic_account_obj.create({
+            'name': 'Parent',
+        })
+        for name in ('Child 1', 'Child 2'):
+            child = self.account_analytic_account_obj.create({
+                'name': name,
+                'parent_id': parent.id,
+            })
+            child.write({'currency_id': self.currency_usd_id.id})
+            self.account_analytic_line_obj.create({
+                'account_id': child.id,
+                'name': name,
+                'journal_id': self.aajournal.id,
+                'date': fields.Date.today(),
+                'amount': 100,
+                'unit_amount': 1,
+                'general_account_id': self.account_rcv_id.id,
+            })
+            self.assertAlmostEqual(50, child.balance)
+        self.assertEqual(self.currency_eur_id, parent.currency_id)
+        self.assertAlmostEqual(200, parent.balance)
+        self.assertAlmostEqual(2, parent.quantity)
+
+    def test_report_currency(self):
+        self.res_currency_rate_model.create({
+            'name': '2015-01-01 00:00:00',
+            'currency_id': self.currency_usd_id.id,
+            'rate': 0.50,
+        })
+        self.res_currency_rate_model.create({
+            'name': '2015-06-01 00:00:00',
+            'currency_id': self.currency_usd_id.id,
+            'rate': 2.0,
+        })
+        parent = self.account_analytic_account_obj.create({
+            'name': 'Parent',
+        })
+        child = self.account_analytic_account_obj.create({
+            'name': 'Child',
+            'parent_id': parent.id,
+        })
+        for account, amount in ((parent, 10), (child, 100)):
+            self.account_analytic_line_obj.create({
+                'account_id': account.id,
+                'name': 'REPORT',
+                'journal_id': self.aajournal.id,
+                'date': '2015-02-01',
+                'amount': amount,
+                'general_account_id': self.account_rcv_id.id,
+            })
+        parent = parent.with_context(
+            report_currency_id=self.currency_usd_id.id,
+            report_date='2015-12-31')
+        self.assertAlmostEqual(220, parent.balance)
+        self.assertAlmostEqual(220, parent.debit)
+        self.assertAlmostEqual(220, parent.ca_invoiced)
+        self.assertAlmostEqual(
+            55, parent.with_context(report_date='2015-03-31').balance)
+
+    def test_currency_subtotals(self):
+        parent = self.account_analytic_account_obj.create({
+            'name': 'Parent',
+        })
+        child = self.account_analytic_account_obj.create({
+            'name': 'Child',
+            'parent_id': parent.id,
+        })
+        for account, amount in ((parent, 10), (child, 100), (child, -30)):
+            self.account_analytic_line_obj.create({
+                'account_id': account.id,
+                'name': 'SUBTOTALS',
+                'journal_id': self.aajournal.id,
+                'date': fields.Date.today(),
+                'amount': amount,
+                'general_account_id': self.account_rcv_id.id,
+            })
+        subtotals = (parent | child).get_currency_subtotals()
+        currency_id = self.main_company.currency_id.id
+        self.assertEqual([currency_id], subtotals[parent.id].keys())
+        parent_values = subtotals[parent.id][currency_id]
+        self.assertAlmostEqual(80, parent_values['balance'])
+        self.assertAlmostEqual(110, parent_values['debit'])
+        self.assertAlmostEqual(parent.balance, parent_values['balance'])
+        self.assertAlmostEqual(
+            70, subtotals[child.id][currency_id]['balance'])
+
+    def test_compute_amounts_batch(self):
+        items = [
+            (self.product_id.id, 2.0, False, self.main_company.id, False),
+            (self.product_id.id, 4.0, False, self.main_company.id,
+             self.aajournal.id),
+            (self.product_id.id, 2.0, False, self.main_company.id, False),
+            (False, 1.0, False, self.main_company.id, False),
+        ]
+        values = self.account_analytic_line_obj.compute_amounts_batch(items)
+        self.assertEqual(len(items), len(values))
+        for item, value in zip(items, values):
+            prod_id, quantity, unit, company_id, journal_id = item
+            res = self.account_analytic_line_obj.on_change_unit_amount(
+                prod_id, quantity, company_id, unit=unit,
+                journal_id=journal_id)
+            self.assertEqual(res.get('value', {}), value)
+        self.assertAlmostEqual(-1000, values[0]['amount'])
+
+    def test_compute_amounts_batch_rounding(self):
+        self.product_id.write({'standard_price': 12.345,
+                               'list_price': 3.215})
+        items = [
+            (self.product_id.id, quantity, False, self.main_company.id,
+             journal_id)
+            for quantity in (0.333, 1.5, 2.675, 7.001)
+            for journal_id in (False, self.aajournal.id)]
+        values = self.account_analytic_line_obj.compute_amounts_batch(items)
+        for item, value in zip(items, values):
+            prod_id, quantity, unit, company_id, journal_id = item
+            res = self.account_analytic_line_obj.on_change_unit_amount(
+                prod_id, quantity, company_id, unit=unit,
+                journal_id=journal_id)
+            self.assertEqual(res['value'], value)
+
+    def test_update_company(self):
+        aal_rs = self.account_analytic_line_obj.create({
+            'account_id': self.agrolait.id,
+            'name': 'AGROLAIT',
+            'journal_id': self.aajournal.id,
+            'date': fields.Date.today(),
+            'amount': 100,
+            'general_account_id': self.account_rcv_id.id,
+        })
+        self.assertEqual(self.account_rcv_id.company_id, aal_rs.company_id)
+        company = self.env['res.company'].create({'name': 'Other Company'})
+        self.env.cr.execute(
+            "UPDATE account_analytic_line SET company_id = %s WHERE id = %s",
+            (company.id, aal_rs.id))
+        self.account_analytic_line_obj._update_company(
+            [self.account_rcv_id.id], chunk_size=1)
+        self.assertEqual(self.account_rcv_id.company_id, aal_rs.company_id)
+        self.assertAlmostEqual(100, aal_rs.aa_amount_currency)
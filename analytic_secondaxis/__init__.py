@@ -30,4 +30,6 @@
 ##############################################################################
 
 from . import analytic_secondaxis
+from . import activity_balance
+from . import activity_violation
 from . import wizard
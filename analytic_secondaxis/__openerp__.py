@@ -60,6 +60,16 @@
 
     What will be true for Administratif, will be true for Intern too.
 
+    The balances of the activities are computed from monthly sums per
+    activity and analytic account, maintained when the analytic lines
+    change, completed by the analytic lines of the partial months of the
+    requested period.
+
+    The activity of an analytic line must be allowed on its analytic
+    account. The analytic lines breaking this rule, e.g. after the
+    activities of an account changed, are listed in the Forbidden Activities
+    report.
+
 """,
     "website": "http://camptocamp.com",
     "license": "AGPL-3",
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2010 Camptocamp SA (http://www.camptocamp.com)
+# All Right Reserved
+#
+# Author : Joel Grand-guillaume (Camptocamp)
+#
+# WARNING: This program as such is intended to be used by professional
+# programmers who take the whole responsability of assessing all potential
+# consequences resulting from its eventual inadequacies and bugs
+# End users who are looking for a ready-to-use solution with commercial
+# garantees and support are strongly adviced to contract a Free Software
+# Service Company
+#
+# This program is Free Software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+##############################################################################
+
+from osv import fields
+from osv import osv
+import decimal_precision as dp
+
+
+class project_activity_balance_month(osv.osv):
+
+    """Sums of the analytic lines per activity, analytic account and month,
+    maintained when the analytic lines are created, written or deleted so
+    that the balances of the activities are computed from these buckets
+    instead of the analytic lines."""
+    _name = "project.activity.balance.month"
+    _description = "Monthly Activity Balance"
+    _log_access = False
+    _order = "month desc, activity_id, account_id"
+
+    _columns = {
+        'activity_id': fields.many2one('project.activity_al', 'Activity',
+                                       required=True, ondelete='cascade'),
+        'account_id': fields.many2one('account.analytic.account',
+                                      'Analytic Account', required=True,
+                                      ondelete='cascade'),
+        'month': fields.date('Month', required=True),
+        'debit': fields.float('Debit',
+                              digits_compute=dp.get_precision('Account')),
+        'credit': fields.float('Credit',
+                               digits_compute=dp.get_precision('Account')),
+        'balance': fields.float('Balance',
+                                digits_compute=dp.get_precision('Account')),
+        'quantity': fields.float('Quantity'),
+    }
+
+    _sql_constraints = [
+        ('activity_account_month_uniq',
+         'unique(activity_id, account_id, month)',
+         'There is only one balance per activity, account and month.'),
+    ]
+
+    def init(self, cr):
+        cr.execute("SELECT 1 FROM project_activity_balance_month LIMIT 1")
+        if not cr.fetchone():
+            cr.execute("""
+                INSERT INTO project_activity_balance_month
+                    (activity_id, account_id, month,
+                     debit, credit, balance, quantity)
+                SELECT l.activity, l.account_id,
+                       date_trunc('month', l.date)::date,
+                       """ + self._get_sums_select() + """
+                FROM account_analytic_line l
+                WHERE l.activity IS NOT NULL
+                GROUP BY 1, 2, 3""")
+
+    def _get_sums_select(self):
+        return """
+            COALESCE(SUM(CASE WHEN l.amount > 0
+                         THEN l.amount ELSE 0.0 END), 0.0),
+            COALESCE(SUM(CASE WHEN l.amount < 0
+                         THEN -l.amount ELSE 0.0 END), 0.0),
+            COALESCE(SUM(l.amount), 0.0),
+            COALESCE(SUM(l.unit_amount), 0.0)"""
+
+    def add_lines(self, cr, line_ids, sign=1):
+        """Add (sign=1) or remove (sign=-1) the analytic lines of line_ids
+        to their buckets"""
+        if not line_ids:
+            return
+        cr.execute("""
+            SELECT l.activity, l.account_id,
+                   date_trunc('month', l.date)::date,
+                   """ + self._get_sums_select() + """
+            FROM account_analytic_line l
+            WHERE l.id IN %s
+            AND l.activity IS NOT NULL
+            GROUP BY 1, 2, 3""", (tuple(line_ids),))
+        # sorted, so concurrent transactions lock the buckets in the same
+        # order
+        rows = sorted(row[:3] + tuple(sign * value for value in row[3:])
+                      for row in cr.fetchall())
+        if not rows:
+            return
+        values = ', '.join(
+            cr.mogrify('(%s, %s, %s::date, %s::float, %s::float, '
+                       '%s::float, %s::float)', row) for row in rows)
+        if cr._cnx.server_version >= 90500:
+            cr.execute("""
+                INSERT INTO project_activity_balance_month AS b
+                    (activity_id, account_id, month,
+                     debit, credit, balance, quantity)
+                VALUES """ + values + """
+                ON CONFLICT (activity_id, account_id, month) DO UPDATE
+                SET debit = b.debit + EXCLUDED.debit,
+                    credit = b.credit + EXCLUDED.credit,
+                    balance = b.balance + EXCLUDED.balance,
+                    quantity = b.quantity + EXCLUDED.quantity""")
+            return
+        # Without ON CONFLICT, the transactions adding lines to the same
+        # buckets are serialized, so two of them cannot insert the same
+        # missing bucket
+        cr.execute("SELECT pg_advisory_xact_lock(hashtext(k)) "
+                   "FROM unnest(%s::text[]) k",
+                   (['project_activity_balance_month-%s-%s-%s' % row[:3]
+                     for row in rows],))
+        cr.execute("""
+            UPDATE project_activity_balance_month b
+            SET debit = b.debit + v.debit,
+                credit = b.credit + v.credit,
+                balance = b.balance + v.balance,
+                quantity = b.quantity + v.quantity
+            FROM (VALUES """ + values + """)
+                AS v(activity_id, account_id, month,
+                     debit, credit, balance, quantity)
+            WHERE b.activity_id = v.activity_id
+            AND b.account_id = v.account_id
+            AND b.month = v.month
+            RETURNING b.activity_id, b.account_id, b.month""")
+        updated = set(cr.fetchall())
+        missing = [row for row in rows if row[:3] not in updated]
+        if missing:
+            cr.execute("""
+                INSERT INTO project_activity_balance_month
+                    (activity_id, account_id, month,
+                     debit, credit, balance, quantity)
+                VALUES """ + ', '.join(
+                cr.mogrify('(%s, %s, %s, %s, %s, %s, %s)', row)
+                for row in missing))
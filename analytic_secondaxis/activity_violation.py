@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2010 Camptocamp SA (http://www.camptocamp.com)
+# All Right Reserved
+#
+# Author : Joel Grand-guillaume (Camptocamp)
+#
+# WARNING: This program as such is intended to be used by professional
+# programmers who take the whole responsability of assessing all potential
+# consequences resulting from its eventual inadequacies and bugs
+# End users who are looking for a ready-to-use solution with commercial
+# garantees and support are strongly adviced to contract a Free Software
+# Service Company
+#
+# This program is Free Software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+##############################################################################
+
+from osv import fields
+from osv import osv
+import tools
+
+
+class project_activity_violation(osv.osv):
+
+    """Analytic lines whose activity is not allowed on their analytic
+    account, i.e. not among the activities of the account or of its
+    nearest parent having activities. The view resolves the activities of
+    all the accounts and is meant for reporting, the analytic lines being
+    checked when written with get_violations."""
+    _name = "project.activity.violation"
+    _description = "Analytic Lines with a Forbidden Activity"
+    _auto = False
+    _order = "date desc, line_id"
+
+    _columns = {
+        'line_id': fields.many2one('account.analytic.line', 'Analytic Line',
+                                   readonly=True),
+        'date': fields.date('Date', readonly=True),
+        'account_id': fields.many2one('account.analytic.account',
+                                      'Analytic Account', readonly=True),
+        'activity_id': fields.many2one('project.activity_al', 'Activity',
+                                       readonly=True),
+        'source_account_id': fields.many2one(
+            'account.analytic.account', 'Account Defining the Activities',
+            readonly=True),
+    }
+
+    def init(self, cr):
+        tools.drop_view_if_exists(cr, 'project_activity_violation')
+        cr.execute("""
+            CREATE OR REPLACE VIEW project_activity_violation AS (
+                WITH RECURSIVE sources(account_id, ancestor_id, depth) AS (
+                    SELECT id, id, 0
+                    FROM account_analytic_account
+                    UNION ALL
+                    SELECT s.account_id, a.parent_id, s.depth + 1
+                    FROM sources s
+                    JOIN account_analytic_account a ON a.id = s.ancestor_id
+                    WHERE a.parent_id IS NOT NULL
+                    AND NOT EXISTS (SELECT 1 FROM proj_activity_analytic_rel r
+                                    WHERE r.analytic_id = s.ancestor_id)
+                ), allowed_sources AS (
+                    SELECT DISTINCT ON (s.account_id)
+                           s.account_id, s.ancestor_id
+                    FROM sources s
+                    WHERE EXISTS (SELECT 1 FROM proj_activity_analytic_rel r
+                                  WHERE r.analytic_id = s.ancestor_id)
+                    ORDER BY s.account_id, s.depth
+                )
+                SELECT l.id AS id,
+                       l.id AS line_id,
+                       l.date AS date,
+                       l.account_id AS account_id,
+                       l.activity AS activity_id,
+                       s.ancestor_id AS source_account_id
+                FROM account_analytic_line l
+                JOIN allowed_sources s ON s.account_id = l.account_id
+                WHERE l.activity IS NOT NULL
+                AND NOT EXISTS (SELECT 1 FROM proj_activity_analytic_rel r
+                                WHERE r.analytic_id = s.ancestor_id
+                                AND r.activity_id = l.activity)
+            )""")
+
+    def get_violations(self, cr, uid, line_ids=None, context=None):
+        """Return the (line id, account id, activity id, source account id)
+        of the analytic lines among line_ids, or of all the analytic lines
+        if line_ids is None, whose activity is not allowed on their account.
+
+        The lines of line_ids are checked against the accounts defining
+        the activities of their account, which are cached (see
+        _get_activity_account_id), instead of resolving the activities of
+        all the accounts through the view.
+        """
+        if line_ids is None:
+            cr.execute("""
+                SELECT line_id, account_id, activity_id, source_account_id
+                FROM project_activity_violation
+                ORDER BY line_id""")
+            return cr.fetchall()
+        if not line_ids:
+            return []
+        cr.execute("""
+            SELECT id, account_id, activity
+            FROM account_analytic_line
+            WHERE id IN %s
+            AND activity IS NOT NULL
+            ORDER BY id""", (tuple(line_ids),))
+        lines = cr.fetchall()
+        activity_obj = self.pool.get('project.activity_al')
+        sources = {}
+        for line_id, account_id, activity_id in lines:
+            if account_id not in sources:
+                sources[account_id] = activity_obj._get_activity_account_id(
+                    cr, uid, account_id)
+        pairs = set((sources[account_id], activity_id)
+                    for line_id, account_id, activity_id in lines
+                    if sources[account_id])
+        if not pairs:
+            return []
+        cr.execute("""
+            SELECT analytic_id, activity_id
+            FROM proj_activity_analytic_rel
+            WHERE (analytic_id, activity_id) IN %s""", (tuple(pairs),))
+        allowed = set(cr.fetchall())
+        return [(line_id, account_id, activity_id, sources[account_id])
+                for line_id, account_id, activity_id in lines
+                if sources[account_id] and
+                (sources[account_id], activity_id) not in allowed]
@@ -29,9 +29,21 @@
 #
 ##############################################################################
 
+import logging
+from datetime import datetime, timedelta
+
+import psycopg2
+
 from osv import fields
 from osv import osv
 import decimal_precision as dp
+import tools
+from tools.translate import _
+
+_logger = logging.getLogger(__name__)
+
+# Fields of the analytic lines summed in project.activity.balance.month
+BALANCE_FIELDS = ('activity', 'account_id', 'date', 'amount', 'unit_amount')
 
 
 class project_activity_al(osv.osv):
@@ -46,31 +58,116 @@ class project_activity_al(osv.osv):
 
     def search(self, cr, uid, args, offset=0, limit=None, order=None,
                context=None, count=False):
-        acc_ids = []
         if context is None:
             context = {}
+        args = args + self._get_context_args(cr, uid, context)
+        return super(project_activity_al, self).search(
+            cr, uid, args, offset, limit, order, context=context, count=count)
+
+    def _get_context_args(self, cr, uid, context):
+        """Return the search criteria given by the context"""
+        args = []
         if context.get('from_date', False):
             args.append(['date', '>=', context['from_date']])
         if context.get('to_date', False):
             args.append(['date', '<=', context['to_date']])
 
         if context.get('account_id', False):
-            aa_obj = self.pool.get('account.analytic.account')
-            account_id = aa_obj.browse(
-                cr, uid, context.get('account_id', False))
-            # take the account wich have activity_ids
-            acc_who_matters = self._get_first_AA_wich_have_activity(
-                cr,
-                uid,
-                account_id
-            )
+            # take the activities of the account wich have activity_ids
+            acc_who_matters = self._get_activity_account_id(
+                cr, uid, context['account_id'])
             if acc_who_matters:
-                for i in acc_who_matters.activity_ids:
-                    acc_ids.append(i.id)
-                args.append(('id', 'in', acc_ids))
+                args.append(('project_ids', 'in', [acc_who_matters]))
+        return args
 
-        return super(project_activity_al, self).search(
-            cr, uid, args, offset, limit, order, context=context, count=count)
+    @tools.ormcache(skiparg=3)
+    def _get_activity_account_id(self, cr, uid, account_id):
+        """Return the id of the first account having activities among the
+        account and its parents (goes bottom up, child, then parent).
+
+        The result is cached until the activities of an account or the
+        hierarchy of the accounts change.
+        """
+        cr.execute("""
+            WITH RECURSIVE ancestors(id, parent_id, depth) AS (
+                SELECT id, parent_id, 0
+                FROM account_analytic_account
+                WHERE id = %s
+                UNION ALL
+                SELECT a.id, a.parent_id, ancestors.depth + 1
+                FROM account_analytic_account a
+                JOIN ancestors ON a.id = ancestors.parent_id
+            )
+            SELECT id FROM ancestors
+            WHERE EXISTS (SELECT 1 FROM proj_activity_analytic_rel r
+                          WHERE r.analytic_id = ancestors.id)
+            ORDER BY depth
+            LIMIT 1""", (account_id,))
+        row = cr.fetchone()
+        return row and row[0] or False
+
+    def _update_parent_path(self, cr, ids):
+        """Recompute the path of the activities of ids and of their
+        descendants from parent_id. The path of each activity of ids is
+        built from its ancestors, not from the path stored on its parent,
+        which may be updated by the same call."""
+        if not ids:
+            return
+        cr.execute("""
+            WITH RECURSIVE ancestors(id, ancestor_id, path) AS (
+                SELECT id, parent_id, id || '/'
+                FROM project_activity_al
+                WHERE id IN %s
+                UNION ALL
+                SELECT ancestors.id, p.parent_id, p.id || '/' || ancestors.path
+                FROM project_activity_al p
+                JOIN ancestors ON p.id = ancestors.ancestor_id
+            ), paths(id, path) AS (
+                SELECT id, path
+                FROM ancestors
+                WHERE ancestor_id IS NULL
+                UNION ALL
+                SELECT a.id, paths.path || a.id || '/'
+                FROM project_activity_al a
+                JOIN paths ON a.parent_id = paths.id
+            )
+            UPDATE project_activity_al a
+            SET parent_path = paths.path
+            FROM (SELECT DISTINCT id, path FROM paths) paths
+            WHERE a.id = paths.id
+            AND a.parent_path IS DISTINCT FROM paths.path""",
+                   (tuple(ids),))
+
+    def create(self, cr, uid, vals, context=None):
+        if vals.get('project_ids'):
+            self.clear_caches()
+        activity_id = super(project_activity_al, self).create(
+            cr, uid, vals, context=context)
+        # also sets the path of the children created through child_ids
+        self._update_parent_path(cr, [activity_id])
+        return activity_id
+
+    def write(self, cr, uid, ids, vals, context=None):
+        if 'project_ids' in vals:
+            self.clear_caches()
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        moved_ids = []
+        if 'child_ids' in vals and ids:
+            # the children removed by the commands are moved as well
+            cr.execute("SELECT id FROM project_activity_al "
+                       "WHERE parent_id IN %s", (tuple(ids),))
+            moved_ids = [row[0] for row in cr.fetchall()]
+        res = super(project_activity_al, self).write(cr, uid, ids, vals,
+                                                     context=context)
+        if 'parent_id' in vals or 'child_ids' in vals:
+            self._update_parent_path(cr, list(set(ids) | set(moved_ids)))
+        return res
+
+    def unlink(self, cr, uid, ids, context=None):
+        self.clear_caches()
+        return super(project_activity_al, self).unlink(cr, uid, ids,
+                                                       context=context)
 
     # @param self The object pointer.
     # @param cr a psycopg cursor.
@@ -91,6 +188,48 @@ class project_activity_al(osv.osv):
             else:
                 return False
 
+    def init(self, cr):
+        # Build the missing or wrong hierarchy paths
+        cr.execute("""
+            WITH RECURSIVE paths(id, path) AS (
+                SELECT id, id || '/'
+                FROM project_activity_al
+                WHERE parent_id IS NULL
+                UNION ALL
+                SELECT a.id, paths.path || a.id || '/'
+                FROM project_activity_al a
+                JOIN paths ON a.parent_id = paths.id
+            )
+            UPDATE project_activity_al a
+            SET parent_path = paths.path
+            FROM paths
+            WHERE a.id = paths.id
+            AND a.parent_path IS DISTINCT FROM paths.path""")
+        cr.execute("SELECT 1 FROM pg_indexes "
+                   "WHERE indexname = 'project_activity_al_parent_path_index'")
+        if not cr.fetchone():
+            cr.execute("CREATE INDEX project_activity_al_parent_path_index "
+                       "ON project_activity_al "
+                       "(parent_path text_pattern_ops)")
+        # Trigram indexes for the substring searches of name_search
+        cr.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        if not cr.fetchone():
+            try:
+                with cr.savepoint():
+                    cr.execute("CREATE EXTENSION pg_trgm")
+            except psycopg2.Error:
+                _logger.warning("The pg_trgm extension cannot be created, "
+                                "the activities are searched without "
+                                "trigram indexes.")
+                return
+        for column in ('code', 'name'):
+            index = 'project_activity_al_%s_trgm_index' % column
+            cr.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s",
+                       (index,))
+            if not cr.fetchone():
+                cr.execute('CREATE INDEX "%s" ON project_activity_al '
+                           'USING gin ("%s" gin_trgm_ops)' % (index, column))
+
     # @param self The object pointer.
     # @param cr a psycopg cursor.
     # @param uid res.user.id that is currently loged
@@ -103,144 +242,415 @@ class project_activity_al(osv.osv):
     def name_search(self, cr, uid, name, args=None,
                     operator='ilike', context=None, limit=80):
         """ Ovveride of osv.osv name serach function that do the search
-            on the name of the activites """
+            on the code and the name of the activites, and includes their
+            children.
+
+            The activities are found by a single query, ranked by exact
+            code, then code or name prefix, then code or name substring
+            matches, then descendants of matching activities, found by
+            their parent_path. The name is matched in the language of the
+            context. With the '=', '=like' and '=ilike' operators, the code
+            or the name must match name as a whole.
+        """
         if not args:
             args = []
         if not context:
             context = {}
-
-        account = self.search(
-            cr,
-            uid,
-            [
-                ('code', '=', name),
-                # ('id','in',acc_ids)
-            ] + args,
-            limit=limit,
-            context=context
-        )
-        if not account:
-            account = self.search(
-                cr,
-                uid,
-                [
-                    ('name', 'ilike', '%%%s%%' % name),
-                    # ('id','in',acc_ids)
-                ] + args,
-                limit=limit,
-                context=context
-            )
-        if not account:
-            account = self.search(
-                cr,
-                uid,
-                [
-                    # ('id','in',acc_ids)
-                ] + args,
-                limit=limit,
-                context=context
-            )
-        # For searching in parent also
-        if not account:
-            account = self.search(
-                cr,
-                uid,
-                [
-                    ('name', 'ilike', '%%%s%%' % name)
-                ] + args,
-                limit=limit,
-                context=context
+        if operator not in ('ilike', 'like', '=', '=ilike', '=like'):
+            return super(project_activity_al, self).name_search(
+                cr, uid, name, args=args, operator=operator,
+                context=context, limit=limit)
+        if not name:
+            ids = self.search(cr, uid, args, limit=limit, context=context)
+            return self.name_get(cr, uid, ids, context=context)
+        like = operator.lstrip('=').upper()
+        # translated name, or source name if there is no translation
+        name_expr = "COALESCE(t.value, a.name)"
+        if operator == '=':
+            where_match = "a.code = %%s OR %s = %%s" % name_expr
+            match_params = [name, name]
+            prefix_params = []
+        elif operator.startswith('='):
+            where_match = ("a.code %s %%s OR %s %s %%s"
+                           % (like, name_expr, like))
+            match_params = [name, name]
+            prefix_params = []
+        else:
+            pattern = (name.replace('\\', '\\\\').replace('%', '\\%')
+                       .replace('_', '\\_'))
+            where_match = ("a.code = %%s OR a.code %s %%s OR %s %s %%s"
+                           % (like, name_expr, like))
+            match_params = [name, '%' + pattern + '%', '%' + pattern + '%']
+            prefix_params = [pattern + '%', pattern + '%']
+        rank_prefix = ''
+        if prefix_params:
+            rank_prefix = ("WHEN a.code %s %%s OR %s %s %%s THEN 1"
+                           % (like, name_expr, like))
+        query = self._where_calc(
+            cr, uid, args + self._get_context_args(cr, uid, context),
+            context=context)
+        self._apply_ir_rules(cr, uid, query, 'read', context=context)
+        from_clause, where_clause, where_params = query.get_sql()
+        cr.execute("""
+            WITH matches(id, rank, parent_path) AS (
+                SELECT a.id,
+                       CASE WHEN a.code = %s THEN 0
+                            """ + rank_prefix + """
+                            ELSE 2
+                       END,
+                       a.parent_path
+                FROM project_activity_al a
+                LEFT JOIN ir_translation t
+                    ON t.res_id = a.id
+                    AND t.name = 'project.activity_al,name'
+                    AND t.type = 'model'
+                    AND t.lang = %s
+                    AND t.value != ''
+                WHERE """ + where_match + """
+            ), found(id, rank) AS (
+                SELECT id, rank
+                FROM matches
+                UNION ALL
+                SELECT d.id, 3
+                FROM project_activity_al d
+                JOIN matches ON d.parent_path LIKE matches.parent_path || '%%'
+                WHERE d.id != matches.id
             )
-            newacc = account
-            while newacc:
-                newacc = self.search(
-                    cr,
-                    uid,
-                    [
-                        ('parent_id', 'in', newacc)
-                    ] + args,
-                    limit=limit,
-                    context=context
-                )
-                account += newacc
-
-        return self.name_get(cr, uid, account, context=context)
+            SELECT found.id
+            FROM found
+            WHERE found.id IN (SELECT "project_activity_al".id
+                               FROM """ + from_clause + """
+                               WHERE """ + (where_clause or 'TRUE') + """)
+            GROUP BY found.id
+            ORDER BY min(found.rank), found.id
+            LIMIT %s""",
+                   [name] + prefix_params +
+                   [context.get('lang') or 'en_US'] + match_params +
+                   where_params + [limit])
+        ids = [row[0] for row in cr.fetchall()]
+        return self.name_get(cr, uid, ids, context=context)
+
+    def _get_rollup_rates(self, cr, uid, pairs, context=None):
+        """Return a dict mapping each (from currency id, to currency id) of
+        pairs to its conversion rate, the pairs missing a currency being
+        left out"""
+        currency_obj = self.pool.get('res.currency')
+        rates = {}
+        for from_id, to_id in pairs:
+            if not from_id or not to_id:
+                continue
+            from_currency = currency_obj.browse(cr, uid, from_id,
+                                                context=context)
+            to_currency = currency_obj.browse(cr, uid, to_id,
+                                              context=context)
+            rates[(from_id, to_id)] = currency_obj._get_conversion_rate(
+                cr, uid, from_currency, to_currency, context=context)
+        return rates
 
     def _compute_level_tree(self, cr, uid, ids, child_ids, res, field_names,
                             context=None):
-        def recursive_computation(account_id, res):
-            currency_obj = self.pool.get('res.currency')
-            account = self.browse(cr, uid, account_id)
-            for son in account.child_ids:
-                res = recursive_computation(son.id, res)
-                for field in field_names:
-                    if (
-                        account.currency_id.id == son.currency_id.id
-                        or field == 'quantity'
-                    ):
-                        res[account.id][field] += res[son.id][field]
-                    else:
-                        res[account.id][field] += currency_obj.compute(
-                            cr, uid, son.currency_id.id,
-                            account.currency_id.id, res[son.id][field],
-                            context=context)
+        """Roll up the values of field_names of the activities of child_ids
+        from the leaves to the activities of ids (see _rollup_tree)"""
+        if not child_ids:
             return res
-        for account in self.browse(cr, uid, ids, context=context):
-            if account.id not in child_ids:
-                continue
-            res = recursive_computation(account.id, res)
+        cr.execute("""
+            SELECT id, parent_id, currency_id
+            FROM project_activity_al
+            WHERE id IN %s""", (tuple(child_ids),))
+        parents = {}
+        currencies = {}
+        for activity_id, parent_id, currency_id in cr.fetchall():
+            currencies[activity_id] = currency_id
+            if parent_id:
+                parents[activity_id] = parent_id
+        return self._rollup_tree(cr, uid, parents, currencies, res,
+                                 field_names, context=context)
+
+    def _rollup_tree(self, cr, uid, parents, currencies, res, field_names,
+                     context=None):
+        """Roll up the values of field_names of res from the leaves to the
+        roots of the tree given by parents and currencies, which map each
+        activity to its parent and to its currency, level by level, without
+        browsing the activities.
+
+        The totals of the children of each level are summed per parent and
+        currency, then converted to the currency of the parent once per
+        distinct pair of currencies.
+        """
+        children = {}
+        for activity_id, parent_id in parents.iteritems():
+            children.setdefault(parent_id, []).append(activity_id)
+        levels = []
+        level = [activity_id for activity_id in currencies
+                 if parents.get(activity_id) not in currencies]
+        while level:
+            levels.append(level)
+            level = [child_id for activity_id in level
+                     for child_id in children.get(activity_id, ())]
+        for level in reversed(levels[1:]):
+            subtotals = {}
+            for activity_id in level:
+                key = (parents[activity_id], currencies[activity_id])
+                subtotal = subtotals.setdefault(
+                    key, dict.fromkeys(field_names, 0.0))
+                for field in field_names:
+                    subtotal[field] += res[activity_id][field]
+            self._add_subtotals(cr, uid, subtotals, currencies, res,
+                                field_names, context=context)
         return res
 
+    def _add_subtotals(self, cr, uid, subtotals, currencies, res,
+                       field_names, context=None):
+        """Add the subtotals, a dict {(activity id, currency id): values},
+        to the values of field_names of the activities in res, converting
+        them to the currency of the activity once per distinct pair of
+        currencies. The amounts of an activity or a line without currency
+        are not converted."""
+        currency_obj = self.pool.get('res.currency')
+        pairs = set((from_id, currencies[activity_id])
+                    for activity_id, from_id in subtotals
+                    if from_id and currencies[activity_id] and
+                    from_id != currencies[activity_id])
+        rates = self._get_rollup_rates(cr, uid, pairs, context=context)
+        to_currencies = dict(
+            (currency.id, currency) for currency in currency_obj.browse(
+                cr, uid, list(set(to_id for from_id, to_id in pairs)),
+                context=context))
+        for (activity_id, from_id), subtotal in subtotals.iteritems():
+            to_id = currencies[activity_id]
+            for field in field_names:
+                amount = subtotal[field]
+                if (from_id, to_id) in rates and field != 'quantity':
+                    amount = currency_obj.round(
+                        cr, uid, to_currencies[to_id],
+                        amount * rates[(from_id, to_id)])
+                res[activity_id][field] += amount
+
+    def _get_subtree_clause(self, cr, ids):
+        """Return the SQL condition selecting the activities of ids and
+        their descendants through their paths, and its parameters"""
+        cr.execute("SELECT parent_path FROM project_activity_al "
+                   "WHERE id IN %s", (tuple(ids),))
+        paths = [row[0] + '%' for row in cr.fetchall() if row[0]]
+        if not paths:
+            return 'FALSE', []
+        return ('(' + ' OR '.join(['a.parent_path LIKE %s'] * len(paths)) +
+                ')'), paths
+
+    def _get_period_clauses(self, context):
+        """Split the period given by the from_date and to_date context keys
+        in the whole months, summed from the monthly balances, and the
+        days at its edges, summed from the analytic lines.
+
+        :return: the SQL conditions on the months of the balances and on
+                 the dates of the lines, and their parameters
+        """
+        from_date = context.get('from_date', False)
+        to_date = context.get('to_date', False)
+        full_from = full_to = None
+        if from_date:
+            full_from = datetime.strptime(from_date, '%Y-%m-%d').date()
+            if full_from.day != 1:
+                full_from = (full_from.replace(day=28) +
+                             timedelta(days=4)).replace(day=1)
+        if to_date:
+            # first day after the last whole month
+            full_to = datetime.strptime(to_date, '%Y-%m-%d').date()
+            full_to = (full_to + timedelta(days=1)).replace(day=1)
+        if full_from and full_to and full_from >= full_to:
+            return ('FALSE', [],
+                    'l.date >= %s AND l.date <= %s', [from_date, to_date])
+        month_where = ['TRUE']
+        month_args = []
+        date_where = []
+        date_args = []
+        if full_from:
+            month_where.append('b.month >= %s')
+            month_args.append(full_from)
+            date_where.append('(l.date >= %s AND l.date < %s)')
+            date_args += [from_date, full_from]
+        if full_to:
+            month_where.append('b.month < %s')
+            month_args.append(full_to)
+            date_where.append('(l.date >= %s AND l.date <= %s)')
+            date_args += [full_to, to_date]
+        return (' AND '.join(month_where), month_args,
+                date_where and ' OR '.join(date_where) or 'FALSE',
+                date_args)
+
     def _debit_credit_bal_qtty(self, cr, uid, ids, name, arg, context=None):
+        """Sum the activities and their descendants with a single query,
+        the descendants being found through their paths, from the monthly
+        balances and the lines of the partial months of the period"""
         res = {}
         if context is None:
             context = {}
-        child_ids = tuple(
-            self.search(cr, uid, [('parent_id', 'child_of', ids)]))
-        for i in child_ids:
-            res[i] = {}
-            for n in name:
-                res[i][n] = 0.0
-
-        if not child_ids:
+        if not ids:
             return res
-
-        where_date = ''
-        where_clause_args = [tuple(child_ids)]
-        if context.get('from_date', False):
-            where_date += " AND l.date >= %s"
-            where_clause_args += [context['from_date']]
-        if context.get('to_date', False):
-            where_date += " AND l.date <= %s"
-            where_clause_args += [context['to_date']]
+        where_subtree, subtree_args = self._get_subtree_clause(cr, ids)
+        where_month, month_args, where_date, date_args = \
+            self._get_period_clauses(context)
         cr.execute("""
-              SELECT a.id,
-                     sum(
+              WITH subtree AS (
+                  SELECT a.id, a.parent_id, a.currency_id
+                  FROM project_activity_al a
+                  WHERE """ + where_subtree + """
+              ), sums AS (
+                  SELECT b.activity_id, b.debit, b.credit, b.balance,
+                         b.quantity
+                  FROM project_activity_balance_month b
+                  WHERE b.activity_id IN (SELECT id FROM subtree)
+                  AND """ + where_month + """
+                  UNION ALL
+                  SELECT l.activity,
                          CASE WHEN l.amount > 0
                          THEN l.amount
                          ELSE 0.0
-                         END
-                          ) as debit,
-                     sum(
+                         END,
                          CASE WHEN l.amount < 0
                          THEN -l.amount
                          ELSE 0.0
-                         END
-                          ) as credit,
-                     COALESCE(SUM(l.amount),0) AS balance,
-                     COALESCE(SUM(l.unit_amount),0) AS quantity
-              FROM project_activity_al a
-                  LEFT JOIN account_analytic_line l ON (a.id = l.activity)
-              WHERE a.id IN %s
-              """ + where_date + """
-              GROUP BY a.id""", where_clause_args)
-        for ac_id, debit, credit, balance, quantity in cr.fetchall():
+                         END,
+                         l.amount,
+                         l.unit_amount
+                  FROM account_analytic_line l
+                  WHERE l.activity IN (SELECT id FROM subtree)
+                  AND (""" + where_date + """)
+              )
+              SELECT t.id, t.parent_id, t.currency_id,
+                     COALESCE(SUM(s.debit), 0) as debit,
+                     COALESCE(SUM(s.credit), 0) as credit,
+                     COALESCE(SUM(s.balance), 0) AS balance,
+                     COALESCE(SUM(s.quantity), 0) AS quantity
+              FROM subtree t
+                  LEFT JOIN sums s ON (s.activity_id = t.id)
+              GROUP BY t.id, t.parent_id, t.currency_id""",
+                   subtree_args + month_args + date_args)
+        parents = {}
+        currencies = {}
+        for (ac_id, parent_id, currency_id,
+             debit, credit, balance, quantity) in cr.fetchall():
             res[ac_id] = {'debit': debit, 'credit': credit,
                           'balance': balance, 'quantity': quantity}
-        return self._compute_level_tree(cr, uid, ids, child_ids, res, [
+            currencies[ac_id] = currency_id
+            if parent_id:
+                parents[ac_id] = parent_id
+        return self._rollup_tree(cr, uid, parents, currencies, res, [
             'debit', 'credit', 'balance', 'quantity'
         ], context)
 
+    def _get_rollup_targets(self, cr, table, ids, include_children):
+        """Return the list of the ids of table whose lines are aggregated
+        and a dict mapping each of them to the ids of ids it is rolled up
+        into (itself and its ancestors in ids when include_children).
+
+        The descendants are found with a single query, through the paths
+        of the activities or the parent_left and parent_right of the
+        analytic accounts.
+        """
+        if not include_children or not ids:
+            return list(ids), dict((record_id, [record_id])
+                                   for record_id in ids)
+        wanted = set(ids)
+        targets = {}
+        if table == 'project_activity_al':
+            where_subtree, subtree_args = self._get_subtree_clause(cr, ids)
+            cr.execute("SELECT a.id, a.parent_path "
+                       "FROM project_activity_al a WHERE " + where_subtree,
+                       subtree_args)
+            for record_id, path in cr.fetchall():
+                targets[record_id] = [int(node_id) for node_id
+                                      in reversed(path.split('/')[:-1])
+                                      if int(node_id) in wanted]
+        else:
+            cr.execute('SELECT a.id, t.id FROM "%s" a '
+                       'JOIN "%s" t ON a.parent_left >= t.parent_left '
+                       'AND a.parent_left < t.parent_right '
+                       'WHERE t.id IN %%s '
+                       'ORDER BY a.id, t.parent_left DESC' % (table, table),
+                       (tuple(wanted),))
+            for record_id, target_id in cr.fetchall():
+                targets.setdefault(record_id, []).append(target_id)
+        return list(targets), targets
+
+    def get_account_activity_matrix(self, cr, uid, account_ids, activity_ids,
+                                    include_children=False, sparse=False,
+                                    context=None):
+        """Return the debit, credit, balance and quantity of the analytic
+        lines of each analytic account and activity, computed by a single
+        query grouped by account and activity.
+
+        The amounts are the ones of the lines, in the currency of their
+        company. The from_date and to_date context keys restrict the lines.
+
+        :param include_children: include the lines of the children of the
+                                 accounts and of the activities
+        :param sparse: return only the cells having lines, in the format
+                       {'accounts': account ids, 'activities': activity
+                       ids, 'cells': [(account index, activity index,
+                       debit, credit, balance, quantity)]}, instead of a
+                       dict {(account id, activity id): {field: value}}
+                       having all the cells
+        """
+        if context is None:
+            context = {}
+        field_names = ('debit', 'credit', 'balance', 'quantity')
+        matrix = {}
+        line_account_ids, account_targets = self._get_rollup_targets(
+            cr, 'account_analytic_account', account_ids, include_children)
+        line_activity_ids, activity_targets = self._get_rollup_targets(
+            cr, 'project_activity_al', activity_ids, include_children)
+        if line_account_ids and line_activity_ids:
+            where_date = ''
+            where_clause_args = [tuple(line_account_ids),
+                                 tuple(line_activity_ids)]
+            if context.get('from_date', False):
+                where_date += " AND l.date >= %s"
+                where_clause_args += [context['from_date']]
+            if context.get('to_date', False):
+                where_date += " AND l.date <= %s"
+                where_clause_args += [context['to_date']]
+            cr.execute("""
+                SELECT l.account_id, l.activity,
+                       COALESCE(SUM(CASE WHEN l.amount > 0
+                                    THEN l.amount ELSE 0.0 END), 0.0),
+                       COALESCE(SUM(CASE WHEN l.amount < 0
+                                    THEN -l.amount ELSE 0.0 END), 0.0),
+                       COALESCE(SUM(l.amount), 0.0),
+                       COALESCE(SUM(l.unit_amount), 0.0)
+                FROM account_analytic_line l
+                WHERE l.account_id IN %s
+                AND l.activity IN %s
+                """ + where_date + """
+                GROUP BY l.account_id, l.activity""", where_clause_args)
+            for row in cr.fetchall():
+                for account_id in account_targets[row[0]]:
+                    for activity_id in activity_targets[row[1]]:
+                        cell = matrix.setdefault((account_id, activity_id),
+                                                 [0.0] * len(field_names))
+                        for index, value in enumerate(row[2:]):
+                            cell[index] += value
+        if sparse:
+            account_index = dict((account_id, index) for index, account_id
+                                 in enumerate(account_ids))
+            activity_index = dict((activity_id, index) for index, activity_id
+                                  in enumerate(activity_ids))
+            return {
+                'accounts': list(account_ids),
+                'activities': list(activity_ids),
+                'cells': sorted(
+                    (account_index[account_id], activity_index[activity_id])
+                    + tuple(values)
+                    for (account_id, activity_id), values
+                    in matrix.iteritems()),
+            }
+        empty = [0.0] * len(field_names)
+        return dict(((account_id, activity_id),
+                     dict(zip(field_names,
+                              matrix.get((account_id, activity_id), empty))))
+                    for account_id in account_ids
+                    for activity_id in activity_ids)
+
     def _default_company(self, cr, uid, context=None):
         user = self.pool.get('res.users').browse(cr, uid, uid, context=context)
         if user.company_id:
@@ -255,12 +665,14 @@ class project_activity_al(osv.osv):
 
     _columns = {
         # activity code
-        'code': fields.char('Code', required=True, size=64),
+        'code': fields.char('Code', required=True, size=64, select=True),
         # name of the code
         'name': fields.char('Activity', required=True, size=64,
                             translate=True),
         # parent activity
         'parent_id': fields.many2one('project.activity_al', 'Parent activity'),
+        # path of the ids of the parent activities, e.g. 1/5/12/
+        'parent_path': fields.char('Parent Path', readonly=True),
         # link to account.analytic account
         'project_ids': fields.many2many(
             'account.analytic.account',
@@ -316,10 +728,36 @@ class project_activity_al(osv.osv):
         'currency_id': _get_default_currency,
     }
 
+    _constraints = [
+        (osv.osv._check_recursion,
+         'Error! You can not create recursive activities.',
+         ['parent_id']),
+    ]
+
 
 class analytic_account(osv.osv):
     _inherit = "account.analytic.account"
 
+    def _clear_activity_caches(self, cr):
+        self.pool.get('project.activity_al').clear_caches()
+
+    def create(self, cr, uid, vals, context=None):
+        if vals.get('activity_ids'):
+            self._clear_activity_caches(cr)
+        return super(analytic_account, self).create(cr, uid, vals,
+                                                    context=context)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        if 'activity_ids' in vals or 'parent_id' in vals:
+            self._clear_activity_caches(cr)
+        return super(analytic_account, self).write(cr, uid, ids, vals,
+                                                   context=context)
+
+    def unlink(self, cr, uid, ids, context=None):
+        self._clear_activity_caches(cr)
+        return super(analytic_account, self).unlink(cr, uid, ids,
+                                                    context=context)
+
     _columns = {
         # Link activity and project
         'activity_ids': fields.many2many(
@@ -337,6 +775,78 @@ class account_analytic_line(osv.osv):
     _name = "account.analytic.line"
     _inherit = "account.analytic.line"
 
+    def init(self, cr):
+        # Partial indexes on the lines having an activity, for the balances
+        # of the activities over a period (activity, date) and for the
+        # account x activity matrix and the forbidden activities report
+        # (account_id, activity)
+        for index, columns in [
+                ('account_analytic_line_activity_date_index',
+                 'activity, date'),
+                ('account_analytic_line_account_activity_index',
+                 'account_id, activity')]:
+            cr.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s",
+                       (index,))
+            if not cr.fetchone():
+                cr.execute('CREATE INDEX "%s" ON account_analytic_line '
+                           '(%s) WHERE activity IS NOT NULL'
+                           % (index, columns))
+
+    def _check_activities(self, cr, uid, ids, context=None):
+        """Raise an error listing all the analytic lines among ids whose
+        activity is not allowed on their analytic account."""
+        violations = self.pool.get('project.activity.violation')\
+            .get_violations(cr, uid, ids, context=context)
+        if not violations:
+            return True
+        account_obj = self.pool.get('account.analytic.account')
+        activity_obj = self.pool.get('project.activity_al')
+        account_names = dict(account_obj.name_get(
+            cr, uid, list(set(row[1] for row in violations)),
+            context=context))
+        activity_names = dict(activity_obj.name_get(
+            cr, uid, list(set(row[2] for row in violations)),
+            context=context))
+        pairs = sorted(set(
+            '%s: %s' % (account_names[account_id], activity_names[activity_id])
+            for line_id, account_id, activity_id, source_id in violations))
+        raise osv.except_osv(
+            _('Error'),
+            _('The following activities are not allowed on the analytic '
+              'account of their line:\n%s') % '\n'.join(pairs))
+
+    def create(self, cr, uid, vals, context=None):
+        line_id = super(account_analytic_line, self).create(
+            cr, uid, vals, context=context)
+        if vals.get('activity'):
+            self._check_activities(cr, uid, [line_id], context=context)
+            self.pool.get('project.activity.balance.month').add_lines(
+                cr, [line_id])
+        return line_id
+
+    def write(self, cr, uid, ids, vals, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        balance_obj = self.pool.get('project.activity.balance.month')
+        update = any(field in vals for field in BALANCE_FIELDS)
+        if update:
+            balance_obj.add_lines(cr, ids, sign=-1)
+        res = super(account_analytic_line, self).write(
+            cr, uid, ids, vals, context=context)
+        if 'activity' in vals or 'account_id' in vals:
+            self._check_activities(cr, uid, ids, context=context)
+        if update:
+            balance_obj.add_lines(cr, ids)
+        return res
+
+    def unlink(self, cr, uid, ids, context=None):
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        self.pool.get('project.activity.balance.month').add_lines(
+            cr, ids, sign=-1)
+        return super(account_analytic_line, self).unlink(
+            cr, uid, ids, context=context)
+
     _columns = {
         'activity': fields.many2one('project.activity_al', 'Activity'),
     }
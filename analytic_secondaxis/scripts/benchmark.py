@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2010 Camptocamp SA (http://www.camptocamp.com)
+# All Right Reserved
+#
+# Author : Joel Grand-guillaume (Camptocamp)
+#
+# WARNING: This program as such is intended to be used by professional
+# programmers who take the whole responsability of assessing all potential
+# consequences resulting from its eventual inadequacies and bugs
+# End users who are looking for a ready-to-use solution with commercial
+# garantees and support are strongly adviced to contract a Free Software
+# Service Company
+#
+# This program is Free Software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+##############################################################################
+"""Benchmark of the activity balances on synthetic analytic lines.
+
+Usage::
+
+    python benchmark.py -d DATABASE [-c CONFIG] [--lines 100000]
+        [--accounts 100] [--activities 10] [--runs 5] [--plans FILE]
+
+A tree of activities, analytic accounts and analytic lines spread over
+them and over 3 years are generated in a transaction rolled back at the
+end, so the benchmark can be run on a copy of a production database. The
+best time of the runs of each aggregate is printed. With --plans, the
+plans of the queries of each aggregate, as explained by EXPLAIN ANALYZE,
+are written in FILE, so they can be compared between two versions.
+
+When analytic_secondaxis_multicurrency is installed, the lines are spread
+over the currencies of the database and the balances summing their
+aa_amount_currency are compared with the single currency balances,
+computed from the monthly balances.
+"""
+
+import optparse
+import time
+
+import openerp
+from openerp import SUPERUSER_ID
+
+from openerp.addons.analytic_secondaxis import analytic_secondaxis
+
+
+def generate(cr, registry, options):
+    """Generate the synthetic activities, accounts and lines and return
+    the ids of the root activities and of the accounts"""
+    activity_obj = registry.get('project.activity_al')
+    account_obj = registry.get('account.analytic.account')
+    root_ids = []
+    for root in range(options.activities):
+        root_id = activity_obj.create(cr, SUPERUSER_ID, {
+            'name': 'Benchmark %s' % root, 'code': 'BENCH%s' % root})
+        root_ids.append(root_id)
+        for child in range(options.activities):
+            activity_obj.create(cr, SUPERUSER_ID, {
+                'name': 'Benchmark %s.%s' % (root, child),
+                'code': 'BENCH%s.%s' % (root, child),
+                'parent_id': root_id})
+    activity_ids = activity_obj.search(
+        cr, SUPERUSER_ID, [('parent_id', 'child_of', root_ids)])
+    account_ids = [account_obj.create(cr, SUPERUSER_ID, {
+        'name': 'Benchmark %s' % i}) for i in range(options.accounts)]
+    cr.execute("SELECT id FROM account_analytic_journal LIMIT 1")
+    journal_id = cr.fetchone()[0]
+    cr.execute("SELECT id FROM account_account WHERE type != 'view' LIMIT 1")
+    general_account_id = cr.fetchone()[0]
+    cr.execute("""
+        INSERT INTO account_analytic_line
+            (name, date, amount, unit_amount, account_id, activity,
+             journal_id, general_account_id)
+        SELECT 'Benchmark', current_date - (i %% 1095),
+               round((random() * 2000 - 1000)::numeric, 2), random() * 10,
+               (%s::integer[])[1 + i %% %s], (%s::integer[])[1 + i %% %s],
+               %s, %s
+        FROM generate_series(1, %s) i""",
+               (account_ids, len(account_ids),
+                activity_ids, len(activity_ids),
+                journal_id, general_account_id, options.lines))
+    if 'aa_amount_currency' in registry.get('account.analytic.line')._columns:
+        cr.execute("SELECT array_agg(id) FROM res_currency")
+        currency_ids = cr.fetchone()[0]
+        cr.execute("""
+            UPDATE account_analytic_line
+            SET aa_currency_id = (%s::integer[])[1 + id %% %s],
+                aa_amount_currency = amount
+            WHERE name = 'Benchmark'""", (currency_ids, len(currency_ids)))
+    cr.execute("DELETE FROM project_activity_balance_month")
+    registry.get('project.activity.balance.month').init(cr)
+    cr.execute("ANALYZE account_analytic_line")
+    cr.execute("ANALYZE project_activity_balance_month")
+    return root_ids, account_ids
+
+
+def explain(cr, plans, label, function, *args):
+    """Write in plans the plans of the SELECT queries executed by a call
+    to function"""
+    queries = []
+    execute = cr.execute
+
+    def record(query, params=None, *a, **kw):
+        queries.append((query, params))
+        return execute(query, params, *a, **kw)
+    cr.execute = record
+    try:
+        function(*args)
+    finally:
+        del cr.execute
+    plans.write('=== %s\n' % label)
+    for query, params in queries:
+        if query.lstrip().upper().startswith(('SELECT', 'WITH')):
+            cr.execute('EXPLAIN (ANALYZE, BUFFERS) ' + query, params)
+            plans.write('\n'.join(row[0] for row in cr.fetchall()))
+            plans.write('\n\n')
+
+
+def measure(label, runs, plans, cr, function, *args):
+    """Print the best time of runs calls to function"""
+    timings = []
+    for run in range(runs):
+        start = time.time()
+        function(*args)
+        timings.append(time.time() - start)
+    print('%-40s %8.1f ms' % (label, min(timings) * 1000))
+    if plans:
+        explain(cr, plans, label, function, *args)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-d', '--database', dest='database')
+    parser.add_option('-c', '--config', dest='config')
+    parser.add_option('--lines', type='int', default=100000)
+    parser.add_option('--accounts', type='int', default=100)
+    parser.add_option('--activities', type='int', default=10)
+    parser.add_option('--runs', type='int', default=5)
+    parser.add_option('--plans', dest='plans')
+    options, args = parser.parse_args()
+    if options.config:
+        openerp.tools.config.parse_config(['-c', options.config])
+    registry = openerp.modules.registry.RegistryManager.get(options.database)
+    plans = options.plans and open(options.plans, 'w')
+    cr = registry.db.cursor()
+    try:
+        root_ids, account_ids = generate(cr, registry, options)
+        activity_obj = registry.get('project.activity_al')
+        activity_ids = activity_obj.search(
+            cr, SUPERUSER_ID, [('parent_id', 'child_of', root_ids)])
+        field_names = ['debit', 'credit', 'balance', 'quantity']
+        base_class = analytic_secondaxis.project_activity_al
+        for label, context in [
+                ('all dates', {}),
+                ('one year', {'from_date': time.strftime('%Y-01-15'),
+                              'to_date': time.strftime('%Y-12-15')})]:
+            measure('single currency, %s' % label, options.runs, plans, cr,
+                    base_class._debit_credit_bal_qtty.im_func, activity_obj,
+                    cr, SUPERUSER_ID, root_ids, field_names, None, context)
+            if activity_obj._debit_credit_bal_qtty.im_func is not \
+                    base_class._debit_credit_bal_qtty.im_func:
+                measure('multicurrency, %s' % label, options.runs, plans,
+                        cr, activity_obj._debit_credit_bal_qtty, cr,
+                        SUPERUSER_ID, root_ids, field_names, None, context)
+            measure('matrix, %s' % label, options.runs, plans, cr,
+                    activity_obj.get_account_activity_matrix, cr,
+                    SUPERUSER_ID, account_ids[:10], activity_ids[:10],
+                    False, True, context)
+            measure('matrix with children, %s' % label, options.runs,
+                    plans, cr, activity_obj.get_account_activity_matrix,
+                    cr, SUPERUSER_ID, account_ids[:10], root_ids, True, True,
+                    context)
+        measure('forbidden activities', options.runs, plans, cr,
+                registry.get('project.activity.violation').get_violations,
+                cr, SUPERUSER_ID)
+    finally:
+        cr.rollback()
+        cr.close()
+        if plans:
+            plans.close()
+
+
+if __name__ == '__main__':
+    main()
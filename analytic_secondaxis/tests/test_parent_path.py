@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2010 Camptocamp SA (http://www.camptocamp.com)
+# All Right Reserved
+#
+# Author : Joel Grand-guillaume (Camptocamp)
+#
+# WARNING: This program as such is intended to be used by professional
+# programmers who take the whole responsability of assessing all potential
+# consequences resulting from its eventual inadequacies and bugs
+# End users who are looking for a ready-to-use solution with commercial
+# garantees and support are strongly adviced to contract a Free Software
+# Service Company
+#
+# This program is Free Software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+##############################################################################
+
+from openerp.tests import common
+
+
+class TestParentPath(common.TransactionCase):
+
+    def setUp(self):
+        super(TestParentPath, self).setUp()
+        self.activity_obj = self.registry('project.activity_al')
+        self.root_id = self.activity_obj.create(self.cr, self.uid, {
+            'name': 'Path Root', 'code': 'PATHROOT'})
+        self.other_id = self.activity_obj.create(self.cr, self.uid, {
+            'name': 'Path Other', 'code': 'PATHOTHER'})
+
+    def _path(self, activity_id):
+        return self.activity_obj.read(
+            self.cr, self.uid, activity_id, ['parent_path'])['parent_path']
+
+    def _create_child(self, code, parent_id):
+        return self.activity_obj.create(self.cr, self.uid, {
+            'name': code, 'code': code, 'parent_id': parent_id})
+
+    def test_create_with_child_ids(self):
+        parent_id = self.activity_obj.create(self.cr, self.uid, {
+            'name': 'Path Parent', 'code': 'PATHPARENT',
+            'parent_id': self.root_id,
+            'child_ids': [(0, 0, {'name': 'Path Child',
+                                  'code': 'PATHCHILD'})]})
+        parent = self.activity_obj.browse(self.cr, self.uid, parent_id)
+        self.assertEqual(1, len(parent.child_ids))
+        self.assertEqual('%s/%s/' % (self.root_id, parent_id),
+                         self._path(parent_id))
+        self.assertEqual('%s/%s/%s/' % (self.root_id, parent_id,
+                                        parent.child_ids[0].id),
+                         self._path(parent.child_ids[0].id))
+
+    def test_link_child_ids(self):
+        child_id = self._create_child('PATHCHILD', self.other_id)
+        grandchild_id = self._create_child('PATHGRANDCHILD', child_id)
+        self.activity_obj.write(self.cr, self.uid, [self.root_id],
+                                {'child_ids': [(4, child_id)]})
+        self.assertEqual('%s/%s/' % (self.root_id, child_id),
+                         self._path(child_id))
+        self.assertEqual('%s/%s/%s/' % (self.root_id, child_id,
+                                        grandchild_id),
+                         self._path(grandchild_id))
+
+    def test_replace_child_ids(self):
+        old_child_id = self._create_child('PATHOLD', self.root_id)
+        child_id = self._create_child('PATHCHILD', self.other_id)
+        grandchild_id = self._create_child('PATHGRANDCHILD', child_id)
+        self.activity_obj.write(self.cr, self.uid, [self.root_id],
+                                {'child_ids': [(6, 0, [child_id])]})
+        self.assertEqual('%s/%s/%s/' % (self.root_id, child_id,
+                                        grandchild_id),
+                         self._path(grandchild_id))
+        self.assertEqual('%s/' % old_child_id, self._path(old_child_id))
+
+    def test_write_parent_id(self):
+        child_id = self._create_child('PATHCHILD', self.root_id)
+        grandchild_id = self._create_child('PATHGRANDCHILD', child_id)
+        self.activity_obj.write(self.cr, self.uid, [child_id],
+                                {'parent_id': self.other_id})
+        self.assertEqual('%s/%s/%s/' % (self.other_id, child_id,
+                                        grandchild_id),
+                         self._path(grandchild_id))
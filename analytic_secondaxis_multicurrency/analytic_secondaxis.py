@@ -29,6 +29,8 @@
 #
 ##############################################################################
 
+import time
+
 from osv import fields
 from osv import osv
 import decimal_precision as dp
@@ -47,56 +49,87 @@ class project_activity_al(osv.osv):
     _inherit = "project.activity_al"
     _description = "Second Analytical Axes"
 
+    def _get_rollup_rates(self, cr, uid, pairs, context=None):
+        """Use the conversion rates cache of analytic_multicurrency"""
+        if context is None:
+            context = {}
+        date = context.get('date') or time.strftime('%Y-%m-%d')
+        rates = self.pool.get('res.currency').get_conversion_rates(
+            cr, uid, [(from_id, to_id, date) for from_id, to_id in pairs
+                      if from_id and to_id], context=context)
+        return dict((key[:2], rate) for key, rate in rates.iteritems())
+
     def _debit_credit_bal_qtty(self, cr, uid, ids, name, arg, context=None):
-        """Replace the original amount column by aa_amount_currency"""
+        """Replace the original amount column by aa_amount_currency.
+
+        The amounts of the lines of the activities and their descendants
+        are summed per activity and currency of their analytic account in
+        a single query, converted to the currency of each activity once per
+        pair of currencies, then rolled up the tree.
+        """
         res = {}
         if context is None:
             context = {}
-        child_ids = tuple(
-            self.search(cr, uid, [('parent_id', 'child_of', ids)]))
-        for i in child_ids:
-            res[i] = {}
-            for n in name:
-                res[i][n] = 0.0
-
-        if not child_ids:
+        if not ids:
             return res
-
+        field_names = ['debit', 'credit', 'balance', 'quantity']
+        where_subtree, subtree_args = self._get_subtree_clause(cr, ids)
         where_date = ''
-        where_clause_args = [tuple(child_ids)]
+        date_args = []
         if context.get('from_date', False):
             where_date += " AND l.date >= %s"
-            where_clause_args += [context['from_date']]
+            date_args.append(context['from_date'])
         if context.get('to_date', False):
             where_date += " AND l.date <= %s"
-            where_clause_args += [context['to_date']]
+            date_args.append(context['to_date'])
         cr.execute("""
-              SELECT a.id,
-                     sum(
-                         CASE WHEN l.aa_amount_currency > 0
-                         THEN l.aa_amount_currency
-                         ELSE 0.0
-                         END
-                          ) as debit,
-                     sum(
-                         CASE WHEN l.aa_amount_currency < 0
-                         THEN -l.aa_amount_currency
-                         ELSE 0.0
-                         END
-                          ) as credit,
-                     COALESCE(SUM(l.aa_amount_currency),0) AS balance,
-                     COALESCE(SUM(l.unit_amount),0) AS quantity
-              FROM account_analytic_account a
-                  LEFT JOIN account_analytic_line l ON (a.id = l.account_id)
-              WHERE a.id IN %s
-              """ + where_date + """
-              GROUP BY a.id""", where_clause_args)
-        for ac_id, debit, credit, balance, quantity in cr.fetchall():
-            res[ac_id] = {'debit': debit, 'credit': credit,
-                          'balance': balance, 'quantity': quantity}
-        return self._compute_level_tree(cr, uid, ids, child_ids, res, [
-            'debit', 'credit', 'balance', 'quantity'
-        ], context)
+              WITH subtree AS (
+                  SELECT a.id, a.parent_id, a.currency_id
+                  FROM project_activity_al a
+                  WHERE """ + where_subtree + """
+              )
+              SELECT t.id, t.parent_id, t.currency_id, s.currency_id,
+                     s.debit, s.credit, s.balance, s.quantity
+              FROM subtree t
+                  LEFT JOIN (
+                      SELECT l.activity, l.aa_currency_id AS currency_id,
+                             SUM(CASE WHEN l.aa_amount_currency > 0
+                                 THEN l.aa_amount_currency
+                                 ELSE 0.0
+                                 END) AS debit,
+                             SUM(CASE WHEN l.aa_amount_currency < 0
+                                 THEN -l.aa_amount_currency
+                                 ELSE 0.0
+                                 END) AS credit,
+                             COALESCE(SUM(l.aa_amount_currency), 0)
+                                 AS balance,
+                             COALESCE(SUM(l.unit_amount), 0) AS quantity
+                      FROM account_analytic_line l
+                      WHERE l.activity IN (SELECT id FROM subtree)
+                      """ + where_date + """
+                      GROUP BY l.activity, l.aa_currency_id
+                  ) s ON (s.activity = t.id)""",
+                   subtree_args + date_args)
+        parents = {}
+        currencies = {}
+        subtotals = {}
+        for row in cr.fetchall():
+            activity_id, parent_id, currency_id, from_id = row[:4]
+            res[activity_id] = dict.fromkeys(field_names, 0.0)
+            currencies[activity_id] = currency_id
+            if parent_id:
+                parents[activity_id] = parent_id
+            if row[4] is not None:
+                # lines without currency are in the activity's currency
+                key = (activity_id, from_id or currency_id)
+                subtotal = subtotals.setdefault(
+                    key, dict.fromkeys(field_names, 0.0))
+                for field, value in zip(field_names, row[4:]):
+                    subtotal[field] += value
+        self._add_subtotals(cr, uid, subtotals, currencies, res,
+                            field_names, context=context)
+        return self._rollup_tree(cr, uid, parents, currencies, res,
+                                 field_names, context=context)
 
     _columns = {
         'balance': fields.function(
@@ -127,4 +160,5 @@ class project_activity_al(osv.osv):
             string='Quantity', multi='debit_credit_bal_qtty'),
     }
 
+
 project_activity_al()
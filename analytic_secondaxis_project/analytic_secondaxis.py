@@ -31,6 +31,7 @@
 
 from osv import fields
 from osv import osv
+import tools
 
 
 class project_work(osv.osv):
@@ -39,29 +40,46 @@ class project_work(osv.osv):
         'activity': fields.many2one('project.activity_al', 'Activity'),
     }
 
+    def _propagate_activity(self, cr, uid, ids, context=None):
+        """Copy the activity of the task works on their timesheet lines,
+        with one write per activity."""
+        groups = {}
+        for work in self.read(cr, uid, ids,
+                              ['activity', 'hr_analytic_timesheet_id'],
+                              context=context, load='_classic_write'):
+            if work['hr_analytic_timesheet_id']:
+                groups.setdefault(work['activity'], []).append(
+                    work['hr_analytic_timesheet_id'])
+        timesheet_obj = self.pool.get('hr.analytic.timesheet')
+        for activity_id, timesheet_ids in groups.iteritems():
+            timesheet_obj.write(cr, uid, timesheet_ids, {
+                'activity': activity_id
+            }, context)
+
     def create(self, cr, uid, vals, *args, **kwargs):
         res = super(project_work, self).create(cr, uid, vals, *args, **kwargs)
         if 'activity' in vals:
-            context = kwargs.get('context', {})
-            task_work_obj = self.pool.get('project.task.work')
-            timesheet_obj = self.pool.get('hr.analytic.timesheet')
-            hr_ts_line_id = task_work_obj.browse(
-                cr, uid, res).hr_analytic_timesheet_id.id
-            timesheet_obj.write(cr, uid, [hr_ts_line_id], {
-                'activity': vals['activity']
-            }, context)
+            context = kwargs.get('context', args and args[0] or None)
+            self._propagate_activity(cr, uid, [res], context=context)
         return res
 
+    def create_multi(self, cr, uid, vals_list, context=None):
+        """Create one task work per dict of vals_list and propagate their
+        activities on the timesheet lines together."""
+        ids = [super(project_work, self).create(cr, uid, vals,
+                                                context=context)
+               for vals in vals_list]
+        self._propagate_activity(
+            cr, uid, [work_id for work_id, vals in zip(ids, vals_list)
+                      if 'activity' in vals], context=context)
+        return ids
+
     def write(self, cr, uid, ids, vals, context=None):
         res = super(project_work, self).write(cr, uid, ids, vals, context)
-        task_work_obj = self.pool.get('project.task.work')
-        timesheet_obj = self.pool.get('hr.analytic.timesheet')
-        for task in self.browse(cr, uid, ids, context=context):
-            hr_ts_line_id = task_work_obj.browse(
-                cr, uid, task.id).hr_analytic_timesheet_id.id
-            timesheet_obj.write(cr, uid, [hr_ts_line_id], {
-                'activity': task.activity.id
-            }, context)
+        if 'activity' in vals:
+            if isinstance(ids, (int, long)):
+                ids = [ids]
+            self._propagate_activity(cr, uid, ids, context=context)
         return res
 
 
@@ -73,20 +91,40 @@ class project_activity_al(osv.osv):
     _inherit = "project.activity_al"
     _description = "Second Analytical Axes"
 
-    def search(self, cr, uid, args, offset=0, limit=None, order=None,
-               context=None, count=False):
+    @tools.ormcache(skiparg=3)
+    def _get_project_account_id(self, cr, uid, project_id):
+        """Return the id of the analytic account of a project.
+
+        The result is cached until a project is written or deleted.
+        """
+        cr.execute("SELECT analytic_account_id FROM project_project "
+                   "WHERE id = %s", (project_id,))
+        row = cr.fetchone()
+        return row and row[0] or False
+
+    def _get_context_args(self, cr, uid, context):
         """Check if we are from project.task.work, if yes, look into the
-        related analytic account of the project."""
-
-        if context is None:
-            context = {}
-        if context.get('from_task', False):
-            if context.get('project_id', False):
-                proj_obj = self.pool.get('project.project')
-                analytic_id = proj_obj.browse(
-                    cr, uid, context.get('project_id', False)
-                ).analytic_account_id.id
-                context.update({'account_id': analytic_id, 'from_task': False})
-
-        return super(project_activity_al, self).search(
-            cr, uid, args, offset, limit, order, context=context, count=count)
+        related analytic account of the project, for both search and
+        name_search."""
+        if context.get('from_task', False) and \
+                context.get('project_id', False):
+            analytic_id = self._get_project_account_id(
+                cr, uid, context['project_id'])
+            context = dict(context, account_id=analytic_id, from_task=False)
+        return super(project_activity_al, self)._get_context_args(
+            cr, uid, context)
+
+
+class project_project(osv.osv):
+    _inherit = "project.project"
+
+    def write(self, cr, uid, ids, vals, context=None):
+        if 'analytic_account_id' in vals:
+            self.pool.get('project.activity_al').clear_caches()
+        return super(project_project, self).write(cr, uid, ids, vals,
+                                                  context=context)
+
+    def unlink(self, cr, uid, ids, context=None):
+        self.pool.get('project.activity_al').clear_caches()
+        return super(project_project, self).unlink(cr, uid, ids,
+                                                   context=context)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+# Copyright (c) 2010 Camptocamp SA (http://www.camptocamp.com)
+# All Right Reserved
+#
+# Author : Joel Grand-guillaume (Camptocamp)
+#
+# WARNING: This program as such is intended to be used by professional
+# programmers who take the whole responsability of assessing all potential
+# consequences resulting from its eventual inadequacies and bugs
+# End users who are looking for a ready-to-use solution with commercial
+# garantees and support are strongly adviced to contract a Free Software
+# Service Company
+#
+# This program is Free Software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+#
+##############################################################################
+
+from openerp.tests import common
+
+
+class TestActivitySearch(common.TransactionCase):
+
+    def setUp(self):
+        super(TestActivitySearch, self).setUp()
+        cr, uid = self.cr, self.uid
+        self.activity_obj = self.registry('project.activity_al')
+        project_obj = self.registry('project.project')
+        self.activity_a_id = self.activity_obj.create(cr, uid, {
+            'name': 'Search Activity A', 'code': 'SEARCHA'})
+        self.activity_b_id = self.activity_obj.create(cr, uid, {
+            'name': 'Search Activity B', 'code': 'SEARCHB'})
+        self.project_id = project_obj.create(cr, uid, {
+            'name': 'Search Project'})
+        project = project_obj.browse(cr, uid, self.project_id)
+        self.registry('account.analytic.account').write(
+            cr, uid, [project.analytic_account_id.id],
+            {'activity_ids': [(6, 0, [self.activity_a_id])]})
+
+    def _name_search(self, name, operator='ilike', context=None):
+        return [activity_id for activity_id, activity_name
+                in self.activity_obj.name_search(
+                    self.cr, self.uid, name, operator=operator,
+                    context=context)]
+
+    def test_name_search_from_task(self):
+        context = {'from_task': True, 'project_id': self.project_id}
+        self.assertEqual([self.activity_a_id],
+                         self._name_search('Search Activity',
+                                           context=context))
+        self.assertEqual([self.activity_a_id, self.activity_b_id],
+                         self._name_search('Search Activity'))
+        self.assertEqual(
+            [self.activity_a_id],
+            self.activity_obj.search(self.cr, self.uid,
+                                     [('code', 'like', 'SEARCH')],
+                                     context=context))
+        self.assertTrue(context['from_task'])
+
+    def test_search_keeps_args(self):
+        context = {'from_task': True, 'project_id': self.project_id}
+        args = [('code', 'like', 'SEARCH')]
+        self.activity_obj.search(self.cr, self.uid, args, context=context)
+        self.assertEqual([('code', 'like', 'SEARCH')], args)
+
+    def test_name_search_operator(self):
+        self.assertEqual([self.activity_b_id],
+                         self._name_search('SEARCHB', operator='='))
+        self.assertEqual([], self._name_search('Search Activity',
+                                               operator='='))
+        self.assertEqual([self.activity_a_id, self.activity_b_id],
+                         self._name_search('Search Activity _',
+                                           operator='=like'))
+        self.assertEqual([], self._name_search('search activity _',
+                                               operator='=like'))
+
+    def test_name_search_empty(self):
+        context = {'from_task': True, 'project_id': self.project_id}
+        self.assertEqual([self.activity_a_id],
+                         self._name_search('', context=context))
+
+    def test_name_search_translated(self):
+        self.registry('ir.translation').create(self.cr, self.uid, {
+            'name': 'project.activity_al,name',
+            'type': 'model',
+            'lang': 'fr_FR',
+            'res_id': self.activity_b_id,
+            'src': 'Search Activity B',
+            'value': 'Recherche Activite B'})
+        self.assertEqual([self.activity_b_id],
+                         self._name_search('Recherche',
+                                           context={'lang': 'fr_FR'}))
+        self.assertEqual([], self._name_search('Recherche'))
+
+    def test_name_search_children(self):
+        child_id = self.activity_obj.create(self.cr, self.uid, {
+            'name': 'Child Activity', 'code': 'CHILDB',
+            'parent_id': self.activity_b_id})
+        self.assertEqual([self.activity_b_id, child_id],
+                         self._name_search('SEARCHB'))